@@ -0,0 +1,91 @@
+#!/usr/bin/env python3
+"""
+Broadcast Serialization Benchmark - CPU cost per screen frame as viewers grow
+
+Compares encoding a broadcast once per recipient (old broadcast_tcp) with
+encoding it once and sharing the buffer (current broadcast_tcp).
+"""
+
+import base64
+import os
+import socket
+import sys
+import threading
+import time
+
+from common import encode_message
+
+FRAME_BYTES = 300 * 1024  # Typical JPEG screen frame before base64
+ROUNDS = 20
+
+
+def make_frame_message():
+    """Build a screen frame message like the server relays"""
+    return {
+        'type': 'screen_frame',
+        'presenter': 'Presenter',
+        'frame': base64.b64encode(os.urandom(FRAME_BYTES)).decode()
+    }
+
+
+def start_sinks(count):
+    """Create socket pairs whose far ends are drained by background threads"""
+    senders = []
+    for _ in range(count):
+        tx, rx = socket.socketpair()
+        threading.Thread(target=drain, args=(rx,), daemon=True).start()
+        senders.append(tx)
+    return senders
+
+
+def drain(sock):
+    buf = bytearray(1 << 20)
+    while sock.recv_into(buf):
+        pass
+
+
+def per_recipient(message, sockets):
+    for sock in sockets:
+        sock.sendall(encode_message(message))
+
+
+def encode_once(message, sockets):
+    data = encode_message(message)
+    for sock in sockets:
+        sock.sendall(data)
+
+
+def measure(func, message, sockets):
+    """Return CPU milliseconds spent by the calling thread per frame"""
+    start = time.thread_time()
+    for _ in range(ROUNDS):
+        func(message, sockets)
+    return (time.thread_time() - start) * 1000 / ROUNDS
+
+
+def main():
+    counts = [int(arg) for arg in sys.argv[1:]] or [1, 5, 10, 20, 30]
+    message = make_frame_message()
+
+    print("=" * 60)
+    print("  BROADCAST SERIALIZATION BENCHMARK")
+    print(f"  Frame payload: {len(message['frame']):,} bytes (base64)")
+    print("=" * 60)
+    print(f"  {'Clients':>7} | {'Per-recipient':>13} | {'Encode once':>11} | {'Saved':>8}")
+    print(f"  {'':>7} | {'(ms CPU)':>13} | {'(ms CPU)':>11} | {'(ms CPU)':>8}")
+    print("-" * 60)
+
+    for count in counts:
+        sockets = start_sinks(count)
+        old = measure(per_recipient, message, sockets)
+        new = measure(encode_once, message, sockets)
+        print(f"  {count:>7} | {old:>13.2f} | {new:>11.2f} | {old - new:>8.2f}")
+        for sock in sockets:
+            sock.close()
+
+    print("=" * 60)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
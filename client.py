@@ -5,9 +5,9 @@ Full-featured GUI client with video, audio, screen sharing, chat, and file trans
 """
 
 import socket
+import select
 import threading
 import struct
-import json
 import tkinter as tk
 from tkinter import ttk, scrolledtext, filedialog, messagebox
 import cv2
@@ -20,9 +20,303 @@ import os
 from datetime import datetime
 import mss
 import time
+from concurrent.futures import ThreadPoolExecutor
+
+from common import (LatestSlot, FrameReader, encode_message, decode_message, send_all,
+                    pack_media_packet, parse_media_packet, pack_nack, media_clock, set_dscp,
+                    select_layer, FecEncoder, FecDecoder, PlayoutBuffer, FrameAssembler, STREAM_VIDEO,
+                    STREAM_AUDIO, STREAM_PROBE, VIDEO_LAYERS, DEFAULT_VIDEO_LAYER, LAYER_TIMEOUT, FEC_FLAG, MAX_FRAGMENT,
+                    TOS_AUDIO, TOS_VIDEO, LEVEL_SILENCE, HEARTBEAT_INTERVAL, HEARTBEAT_TIMEOUT,
+                    MAX_FRAME, FEC_MIN_GROUP, FEC_MAX_GROUP)
+
+# Receivers report what arrived this often; senders adapt on the same cadence
+REPORT_INTERVAL = 2.0
+
+# How often the UDP receiver looks for fragments to NACK (seconds)
+NACK_CHECK_INTERVAL = 0.01
+
+# Duration of one audio packet: 2048-frame chunks at 16 kHz
+AUDIO_CHUNK_SECONDS = 2048 / 16000
+
+# Multicast mode: probes sent before falling back to unicast, and their spacing
+MULTICAST_PROBES = 3
+MULTICAST_PROBE_INTERVAL = 2.0
+
+# JPEG decode flags by downscale factor; libjpeg skips the discarded detail,
+# so reduced decodes are several times cheaper than decode-then-resize
+DECODE_SCALES = (
+    (1, cv2.IMREAD_COLOR),
+    (2, cv2.IMREAD_REDUCED_COLOR_2),
+    (4, cv2.IMREAD_REDUCED_COLOR_4),
+    (8, cv2.IMREAD_REDUCED_COLOR_8),
+)
+
+
+def audio_level(pcm):
+    """Loudness of a 16-bit PCM chunk in -dBov (0 loudest, 127 silence)"""
+    samples = np.frombuffer(pcm, dtype=np.int16).astype(np.float32)
+    if not len(samples):
+        return LEVEL_SILENCE
+    rms = float(np.sqrt(np.mean(samples * samples)))
+    if rms < 1:
+        return LEVEL_SILENCE
+    return max(0, min(LEVEL_SILENCE, int(-20 * np.log10(rms / 32768))))
+
+class VideoTileManager:
+    """Keeps one persistent tile per participant in the video grid.
+
+    Tiles are created and destroyed only when participants appear or leave;
+    frame updates paste into the tile's existing PhotoImage. Must be used
+    from the main thread.
+    """
+    
+    def __init__(self, container):
+        self.container = container
+        self.tiles = {}  # {username: {'frame': Frame, 'video_label': Label, 'photo': PhotoImage, 'version': int}}
+        self.order = []  # Usernames in grid order
+        self.grid_shape = (0, 0)  # (rows, cols) currently configured
+        
+        self.placeholder = tk.Label(container, text="No active video streams",
+                                    anchor=tk.CENTER, bg='gray20', fg='white')
+        self.layout()
+    
+    def sync(self, usernames):
+        """Add and remove tiles so they match usernames, re-laying out on change"""
+        if usernames == self.order:
+            return
+        
+        for username in [u for u in self.order if u not in usernames]:
+            self.tiles.pop(username)['frame'].destroy()
+        for username in usernames:
+            if username not in self.tiles:
+                self.tiles[username] = self._create_tile(username)
+        
+        self.order = list(usernames)
+        self.layout()
+    
+    def _create_tile(self, username):
+        video_frame = tk.Frame(self.container, relief=tk.SOLID, borderwidth=2, bg='black',
+                               highlightthickness=3, highlightbackground='black')
+        
+        name_label = tk.Label(video_frame, text=username, bg='black',
+                              fg='white', font=('Arial', 10, 'bold'))
+        name_label.pack(side=tk.TOP, pady=2)
+        
+        video_label = tk.Label(video_frame, bg='black')
+        video_label.pack(expand=True, fill=tk.BOTH)
+        
+        return {'frame': video_frame, 'video_label': video_label, 'photo': None, 'version': None,
+                'highlighted': False}
+    
+    def layout(self):
+        """Place tiles (or the placeholder) on the grid"""
+        num_videos = len(self.order)
+        if num_videos == 0:
+            cols, rows = 1, 1
+            self.placeholder.grid(row=0, column=0, sticky='nsew')
+        else:
+            cols = min(3, num_videos)
+            rows = (num_videos + cols - 1) // cols
+            self.placeholder.grid_remove()
+            for i, username in enumerate(self.order):
+                self.tiles[username]['frame'].grid(row=i // cols, column=i % cols,
+                                                   padx=5, pady=5, sticky='nsew')
+        
+        # Configure grid weights for responsive layout, clearing stale rows/columns
+        old_rows, old_cols = self.grid_shape
+        for i in range(max(cols, old_cols)):
+            self.container.grid_columnconfigure(i, weight=1 if i < cols else 0)
+        for i in range(max(rows, old_rows)):
+            self.container.grid_rowconfigure(i, weight=1 if i < rows else 0)
+        self.grid_shape = (rows, cols)
+    
+    def highlight(self, usernames, color):
+        """Outline the tiles of usernames (the active speakers) in color"""
+        for username, tile in self.tiles.items():
+            highlighted = username in usernames
+            if tile['highlighted'] != highlighted:
+                tile['frame'].config(highlightbackground=color if highlighted else 'black')
+                tile['highlighted'] = highlighted
+    
+    def cell_size(self):
+        """Approximate (width, height) available for video in one tile, None before layout"""
+        rows, cols = self.grid_shape
+        width = self.container.winfo_width()
+        height = self.container.winfo_height()
+        if not self.order or width <= 1 or height <= 1:
+            return None
+        # Minus padding, border and the name label
+        return (max(1, width // cols - 14), max(1, height // rows - 34))
+    
+    def version(self, username):
+        """Version of the frame currently shown in a tile"""
+        tile = self.tiles.get(username)
+        return tile['version'] if tile else None
+    
+    def update_image(self, username, img, version):
+        """Show an RGB PIL image in a tile, reusing its PhotoImage when possible"""
+        tile = self.tiles.get(username)
+        if not tile:
+            return
+        
+        photo = tile['photo']
+        if photo and (photo.width(), photo.height()) == img.size:
+            photo.paste(img)
+        else:
+            photo = ImageTk.PhotoImage(img)
+            tile['photo'] = photo
+            tile['video_label'].config(image=photo)
+            tile['video_label'].image = photo  # Keep reference
+        tile['version'] = version
+
+class CameraGrabber:
+    """Reads a camera on its own thread, keeping only the newest frame.
+
+    When the device delivers MJPEG at the requested size, frames are kept
+    as the camera's own JPEG bytes so they can be sent without a decode and
+    re-encode. take() returns (is_jpeg, data): JPEG bytes or a BGR array.
+    """
+    
+    def __init__(self, cap, width, height):
+        self.cap = cap
+        self.slot = LatestSlot()
+        self.running = False
+        self.failed = False
+        self.passthrough = self._enable_mjpeg_passthrough(width, height)
+    
+    def _enable_mjpeg_passthrough(self, width, height):
+        """Ask for raw MJPEG at width x height; True if the camera complies"""
+        mjpg = cv2.VideoWriter_fourcc(*'MJPG')
+        try:
+            self.cap.set(cv2.CAP_PROP_FOURCC, mjpg)
+            self.cap.set(cv2.CAP_PROP_FRAME_WIDTH, width)
+            self.cap.set(cv2.CAP_PROP_FRAME_HEIGHT, height)
+            if int(self.cap.get(cv2.CAP_PROP_FOURCC)) != mjpg:
+                return False
+            if (int(self.cap.get(cv2.CAP_PROP_FRAME_WIDTH)), int(self.cap.get(cv2.CAP_PROP_FRAME_HEIGHT))) != (width, height):
+                return False
+            if not self.cap.set(cv2.CAP_PROP_CONVERT_RGB, 0):
+                return False
+            
+            # Backends that ignore CONVERT_RGB still hand back decoded frames
+            ret, raw = self.cap.read()
+            if ret and raw is not None and raw.ndim <= 2 and raw.size > 2:
+                raw = raw.reshape(-1)
+                if raw[0] == 0xFF and raw[1] == 0xD8:  # JPEG SOI marker
+                    return True
+            self.cap.set(cv2.CAP_PROP_CONVERT_RGB, 1)
+        except Exception as e:
+            print(f"MJPEG passthrough unavailable: {e}")
+        return False
+    
+    def start(self):
+        self.running = True
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+    
+    def stop(self):
+        self.running = False
+        self.slot.close()
+    
+    def join(self, timeout=None):
+        """Wait for the capture thread to leave cap.read(); False if it did not"""
+        self.thread.join(timeout)
+        return not self.thread.is_alive()
+    
+    def take(self, timeout=None):
+        """Newest frame not yet taken, or None"""
+        return self.slot.take(timeout)
+    
+    def _run(self):
+        error_count = 0
+        while self.running:
+            try:
+                ret, frame = self.cap.read()
+            except Exception:
+                ret, frame = False, None
+            
+            if not ret or frame is None:
+                error_count += 1
+                if error_count > 10:
+                    self.failed = True
+                    self.stop()
+                    break
+                time.sleep(0.1)
+                continue
+            
+            error_count = 0  # Reset on successful read
+            if self.passthrough:
+                self.slot.put((True, frame.tobytes()))
+            else:
+                self.slot.put((False, frame))
+
+class CongestionController:
+    """Chooses the video operating point from receiver reports.
+
+    Operating points trade resolution, frame rate and JPEG quality. The
+    worst loss among fresh reports drives the choice: quick steps down on
+    loss, one step up after several clean intervals.
+    """
+    
+    # (highest simulcast layer, fps, JPEG quality), best first
+    LADDER = (
+        (2, 30, 40),
+        (2, 20, 35),
+        (1, 20, 35),
+        (1, 15, 30),
+        (1, 10, 25),
+        (0, 10, 25),
+        (0, 5, 20),
+    )
+    HIGH_LOSS = 0.10
+    SEVERE_LOSS = 0.25
+    LOW_LOSS = 0.02
+    HIGH_JITTER = 40.0  # ms; holds quality steady instead of raising it
+    CLEAN_INTERVALS_TO_RAISE = 3
+    
+    def __init__(self):
+        self.level = 0
+        self.clean_intervals = 0
+        self.reports = {}  # {receiver: (received_at, loss, jitter)}
+        self.last_update = time.time()
+    
+    def on_report(self, report):
+        """Record a receiver_report from the server (any thread)"""
+        self.reports[report['receiver']] = (time.time(), report.get('loss', 0.0), report.get('jitter', 0.0))
+    
+    def update(self):
+        """Re-evaluate once per report interval; returns (max_layer, fps, quality)"""
+        now = time.time()
+        if now - self.last_update >= REPORT_INTERVAL:
+            self.last_update = now
+            fresh = [(loss, jitter) for received_at, loss, jitter in list(self.reports.values())
+                     if now - received_at < REPORT_INTERVAL * 2]
+            if fresh:
+                self._adapt(max(loss for loss, _ in fresh), max(jitter for _, jitter in fresh))
+        return self.LADDER[self.level]
+    
+    def _adapt(self, loss, jitter):
+        previous = self.level
+        if loss >= self.SEVERE_LOSS:
+            self.level = min(self.level + 2, len(self.LADDER) - 1)
+            self.clean_intervals = 0
+        elif loss >= self.HIGH_LOSS:
+            self.level = min(self.level + 1, len(self.LADDER) - 1)
+            self.clean_intervals = 0
+        elif loss <= self.LOW_LOSS and jitter < self.HIGH_JITTER:
+            self.clean_intervals += 1
+            if self.clean_intervals >= self.CLEAN_INTERVALS_TO_RAISE and self.level > 0:
+                self.level -= 1
+                self.clean_intervals = 0
+        else:
+            self.clean_intervals = 0
+        
+        if self.level != previous:
+            layer, fps, quality = self.LADDER[self.level]
+            print(f"📶 Video adapted to layer {layer}, {fps} FPS, quality {quality} (loss {loss:.0%})")
 
 class LANClient:
-    def __init__(self, master):
+    def __init__(self, master, max_video_fps=None, fec_group_sizes=None):
         self.master = master
         self.master.title("🌐 LAN Collaboration Suite")
         self.master.geometry("1400x900")
@@ -48,12 +342,21 @@ class LANClient:
         # Connection state
         self.connected = False
         self.username = None
+        self.room = None  # Meeting joined on this server
         self.server_ip = None
         self.server_tcp_port = 5555
         self.server_udp_port = 5556
         self.tcp_socket = None
+        self.tcp_reader = None  # FrameReader for the control connection
+        self.compress = False  # Server accepted zlib-compressed control messages
         self.udp_socket = None
+        self.audio_socket = None  # Sends audio only, marked for voice priority
         self.udp_port = 0
+        self.screen_socket = None  # Dedicated TCP channel for screen frames
+        self.screen_reader = None
+        self.multicast_socket = None  # Joined to the room's group in multicast mode
+        self.multicast_confirmed = False  # Server switched our media to the group
+        self.multicast_layers = {}  # {(sender, layer): last time seen on the group}
         
         # Streaming state
         self.video_streaming = False
@@ -61,17 +364,51 @@ class LANClient:
         self.presenting = False
         self.presenter = None
         
+        # Screen sharing components
+        self.screen_frame_slot = LatestSlot()  # Newest undecoded screen_frame message
+        self.screen_image_slot = LatestSlot()  # Newest decoded RGB image for the UI thread
+        self.screen_photo = None  # PhotoImage reused while the frame size is unchanged
+        
         # Video components
         self.video_cap = None
-        self.video_frames = {}  # {username: frame}
+        self.video_thread = None  # stream_video, which owns the CameraGrabber
+        self.video_packets = {}  # {username: latest compressed (JPEG) frame}
+        self.video_packet_versions = {}  # {username: counter bumped on every new packet}
+        self.video_frames = {}  # {username: decoded RGB frame}
+        self.video_frame_versions = {}  # {username: packet version the frame was decoded from}
+        self.video_source_sizes = {}  # {username: (width, height) of the full-size frame}
+        self.video_decoding = set()  # Usernames with a decode in flight
+        self.simulcast_layers = tuple(range(len(VIDEO_LAYERS)))  # Layers this client sends
+        self.requested_layers = {}  # {sender: simulcast layer asked of the server}
+        self.max_video_fps = max_video_fps  # Cap on received video fps (None = unlimited)
+        self.media_seq = {}  # {(stream_type, layer): next sequence number to send}
+        
+        # Forward error correction: one parity packet per N media packets
+        self.fec_group_sizes = fec_group_sizes or {}  # {stream_type: N}, missing/0 = off
+        self.fec_encoders = {}  # {(stream_type, layer): FecEncoder}
+        self.fec_decoders = {}  # {(sender, stream_type, layer): FecDecoder}, created on first parity
+        self.audio_playout = {}  # {(sender, stream_type, layer): PlayoutBuffer} for audio with FEC
+        self.frame_assemblers = {}  # {(sender, layer): FrameAssembler}
+        self.congestion = CongestionController()
+        
+        # Receiver statistics for receiver reports
+        self.receive_stats = {}  # {sender: {'received': packets, 'bytes': bytes}} since last report
+        self.receive_jitter = {}  # {sender: [jitter_ms, last_transit_ms]}
+        self.receive_stats_lock = threading.Lock()
+        self.last_report_time = time.time()
+        self.video_decode_pool = ThreadPoolExecutor(max_workers=2, thread_name_prefix='video-decode')
+        self.video_tiles = None  # VideoTileManager, created with the main UI
+        self.active_speakers = []  # Announced by the server, loudest first
         
         # Audio components
         self.audio = pyaudio.PyAudio()
         self.audio_input_stream = None
         self.audio_output_stream = None
         
-        # Users list
+        # Users list, kept in step with the server by numbered presence deltas
         self.users = []
+        self.presence_version = 0
+        self.presence_resyncing = False  # Snapshot requested after a missed delta
         
         # Running flag
         self.running = True
@@ -107,7 +444,8 @@ class LANClient:
             ("👤 Username", "username_entry", ""),
             ("🌐 Server IP", "server_entry", "192.168.1.100"),
             ("🔌 TCP Port", "tcp_port_entry", "5555"),
-            ("📡 UDP Port", "udp_port_entry", "5556")
+            ("📡 UDP Port", "udp_port_entry", "5556"),
+            ("🚪 Room", "room_entry", "main")
         ]
         
         for idx, (label_text, attr_name, default_val) in enumerate(fields, start=2):
@@ -156,33 +494,26 @@ class LANClient:
                                      bg=self.colors['bg_medium'], 
                                      fg=self.colors['error'])
         self.status_label.grid(row=8, column=0, columnspan=2)
-    def send_message(self, data):
-     """Send a JSON message via TCP to the server"""
-     if self.tcp_socket:
+    def send_message(self, data, sock=None):
+     """Send a JSON message via TCP to the server (control socket by default)"""
+     sock = sock or self.tcp_socket
+     if sock:
         try:
-            msg = json.dumps(data).encode('utf-8')
-            # Send message length first
-            self.tcp_socket.sendall(struct.pack('>I', len(msg)) + msg)
+            # Length-prefixed JSON frame
+            send_all(sock, encode_message(data, self.compress))
         except Exception as e:
             print(f"Send message error: {e}")
 
-    def recv_message(self):
-     """Receive a JSON message via TCP from the server"""
-     if self.tcp_socket:
+    def recv_message(self, reader=None, idle_timeout=None):
+     """Receive a JSON message via TCP from the server (control connection by default)"""
+     reader = reader or self.tcp_reader
+     if reader:
         try:
-            # First, read 4 bytes for message length
-            raw_len = self.tcp_socket.recv(4)
-            if not raw_len:
+            # Length-prefixed JSON frame, None at EOF or after idle_timeout of silence
+            frame = reader.read_frame(idle_timeout)
+            if frame is None:
                 return None
-            msg_len = struct.unpack('>I', raw_len)[0]
-            # Then read the actual message
-            data = b''
-            while len(data) < msg_len:
-                packet = self.tcp_socket.recv(msg_len - len(data))
-                if not packet:
-                    return None
-                data += packet
-            return json.loads(data.decode('utf-8'))
+            return decode_message(frame)
         except Exception as e:
             print(f"Receive message error: {e}")
             return None
@@ -191,6 +522,7 @@ class LANClient:
         """Connect to server"""
         self.username = self.username_entry.get().strip()
         self.server_ip = self.server_entry.get().strip()
+        self.room = self.room_entry.get().strip() or 'main'
         
         if not self.username or not self.server_ip:
             self.status_label.config(text="Please enter username and server IP")
@@ -208,25 +540,40 @@ class LANClient:
             # Create TCP socket
             self.tcp_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
             self.tcp_socket.connect((self.server_ip, tcp_port))
+            self.tcp_reader = FrameReader(self.tcp_socket)
+            self.tcp_reader.compressed = True  # We offer zlib, so registered may use it
             
             # Create UDP socket
             self.udp_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
             self.udp_socket.bind(('', 0))  # Bind to any available port
             self.udp_port = self.udp_socket.getsockname()[1]
+            set_dscp(self.udp_socket, TOS_VIDEO)
+            self.audio_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            set_dscp(self.audio_socket, TOS_AUDIO)
             
             # Register with server
             self.send_message({
                 'type': 'register',
                 'username': self.username,
-                'udp_port': self.udp_port
+                'udp_port': self.udp_port,
+                'room': self.room,
+                'compression': ['zlib']
             })
             
             # Wait for registration response
             response = self.recv_message()
             if response and response['type'] == 'registered':
                 self.connected = True
+                self.compress = response.get('compression') == 'zlib'
+                self.tcp_reader.compressed = self.compress
+                self.room = response.get('room', self.room)
+                # A sharded server serves each room's media from its own worker port
+                self.server_udp_port = response.get('udp_port', self.server_udp_port)
+                self.master.title(f"🌐 LAN Collaboration Suite - {self.room}")
                 self.users = response['users']
+                self.presence_version = response.get('presence_version', 0)
                 self.presenter = response.get('presenter')
+                self.active_speakers = response.get('active_speakers', [])
                 
                 # Build main UI
                 self.build_main_ui()
@@ -235,11 +582,43 @@ class LANClient:
                 for msg in response.get('chat_history', []):
                     self.display_chat_message(msg)
                 
+                # Weak machines and wall displays ask the server to thin video
+                if self.max_video_fps:
+                    self.send_message({
+                        'type': 'max_fps',
+                        'sender': None,
+                        'fps': self.max_video_fps
+                    })
+                
+                # Periodic receiver reports drive the senders' congestion control
+                self.last_report_time = time.time()
+                self.master.after(int(REPORT_INTERVAL * 1000), self.send_receiver_reports)
+                
+                # Heartbeats let the server reap us quickly if we vanish, and
+                # the server's own heartbeats let us notice when it does
+                self.tcp_socket.settimeout(HEARTBEAT_TIMEOUT)
+                self.master.after(int(HEARTBEAT_INTERVAL * 1000), self.send_heartbeat)
+                
+                # Receive room media from its multicast group when the server offers one
+                # (fps thinning is per receiver, so it needs unicast)
+                multicast = response.get('multicast')
+                if multicast and not self.max_video_fps and self.join_multicast(multicast['group'],
+                                                                                 multicast['port']):
+                    self.send_multicast_probe(MULTICAST_PROBES)
+                
+                # Open the dedicated screen sharing channel
+                self.connect_screen_channel(response.get('screen_port'), response.get('screen_token'))
+                
                 # Start receiver threads
                 threading.Thread(target=self.receive_tcp_messages, daemon=True).start()
                 threading.Thread(target=self.receive_udp_streams, daemon=True).start()
+                if self.screen_socket:
+                    threading.Thread(target=self.receive_screen_frames, daemon=True).start()
+                    threading.Thread(target=self.decode_screen_frames, daemon=True).start()
                 
                 print(f"Connected to server as {self.username}")
+            elif response and response['type'] == 'register_rejected':
+                raise Exception(response.get('reason', "Registration rejected"))
             else:
                 raise Exception("Registration failed")
                 
@@ -249,6 +628,62 @@ class LANClient:
                 self.tcp_socket.close()
             if self.udp_socket:
                 self.udp_socket.close()
+            if self.audio_socket:
+                self.audio_socket.close()
+    
+    def join_multicast(self, group, port):
+        """Open a socket subscribed to the room's multicast group"""
+        try:
+            sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            if hasattr(socket, 'SO_REUSEPORT'):
+                # Several clients on one machine share the group port
+                sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+            try:
+                sock.bind((group, port))  # Only this group's traffic
+            except OSError:
+                sock.bind(('', port))  # Windows cannot bind to a group address
+            membership = struct.pack('4s4s', socket.inet_aton(group), socket.inet_aton('0.0.0.0'))
+            sock.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, membership)
+        except OSError as e:
+            print(f"Multicast unavailable ({e}), using unicast")
+            return False
+        self.multicast_socket = sock
+        return True
+    
+    def send_multicast_probe(self, remaining):
+        """Ask the server to prove the group reaches us; give up after a few tries"""
+        if not self.connected or self.multicast_confirmed or not self.multicast_socket:
+            return
+        if remaining == 0:
+            # Probes never arrived: multicast routing is blocked on this network
+            print("Multicast probe not received, using unicast")
+            sock, self.multicast_socket = self.multicast_socket, None
+            sock.close()
+            return
+        self.send_message({'type': 'multicast_probe'})
+        self.master.after(int(MULTICAST_PROBE_INTERVAL * 1000), self.send_multicast_probe, remaining - 1)
+    
+    def connect_screen_channel(self, screen_port, screen_token):
+        """Open the second TCP connection used only for screen frames"""
+        if not screen_port:
+            return
+        try:
+            self.screen_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            self.screen_socket.connect((self.server_ip, screen_port))
+            self.screen_reader = FrameReader(self.screen_socket)
+            self.send_message({
+                'type': 'screen_hello',
+                'username': self.username,
+                'token': screen_token
+            }, sock=self.screen_socket)
+        except Exception as e:
+            print(f"Screen channel error: {e}")
+            try:
+                self.screen_socket.close()
+            except:
+                pass
+            self.screen_socket = None
     
     def build_main_ui(self):
         """Build main application UI"""
@@ -281,6 +716,7 @@ class LANClient:
         
         self.video_container = tk.Frame(video_frame, bg=self.colors['bg_dark'])
         self.video_container.pack(fill=tk.BOTH, expand=True, padx=5, pady=5)
+        self.video_tiles = VideoTileManager(self.video_container)
         
         # Video controls
         video_controls = tk.Frame(video_frame, bg=self.colors['bg_medium'])
@@ -446,7 +882,8 @@ class LANClient:
                 self.video_streaming = True
                 # Update button in main thread
                 self.master.after(0, lambda: self.video_btn.config(text="⏹️ Stop Video"))
-                threading.Thread(target=self.stream_video, daemon=True).start()
+                self.video_thread = threading.Thread(target=self.stream_video, daemon=True)
+                self.video_thread.start()
                 print(f"✅ Video started successfully for {self.username}")
             except Exception as e:
                 messagebox.showerror("Error", f"Video error: {e}\n\nTry restarting the client.")
@@ -459,9 +896,6 @@ class LANClient:
             # Stop video streaming
             self.video_streaming = False
             
-            # Wait for thread to notice
-            time.sleep(0.2)
-            
             # Update button in main thread
             self.master.after(0, lambda: self.video_btn.config(text="📹 Start Video"))
             
@@ -469,14 +903,20 @@ class LANClient:
             threading.Thread(target=self._close_camera, daemon=True).start()
             
             # Remove own video from display
-            if self.username in self.video_frames:
-                del self.video_frames[self.username]
+            self.remove_video_stream(self.username)
             
             print(f"Video stopped for {self.username}")
     
     def _close_camera(self):
-        """Safely close camera without blocking"""
+        """Safely close camera once nothing is reading from it"""
         try:
+            # stream_video stops and joins its grabber on the way out; the
+            # capture must not be released while a cap.read() is in flight
+            thread = self.video_thread
+            if thread and thread is not threading.current_thread():
+                thread.join(timeout=3.0)
+                if thread.is_alive():
+                    print("⚠️ Video thread still busy, releasing camera anyway")
             if self.video_cap:
                 try:
                     self.video_cap.release()
@@ -490,68 +930,142 @@ class LANClient:
         """Stream video to server"""
         print(f"📹 Starting video stream for {self.username}")
         frame_count = 0
-        error_count = 0
+        last_send = 0
+        
+        # Capture runs on its own thread so stale frames never queue up
+        top_layer = max(self.simulcast_layers)
+        grabber = CameraGrabber(self.video_cap, *VIDEO_LAYERS[top_layer])
+        grabber.start()
+        if grabber.passthrough:
+            print(f"📹 Camera delivers MJPEG, forwarding compressed frames")
         
         while self.video_streaming and self.running:
             try:
-                ret, frame = self.video_cap.read()
-                if not ret or frame is None:
-                    error_count += 1
-                    if error_count > 10:
+                # Operating point from receiver feedback
+                max_layer, fps, quality = self.congestion.update()
+                layers = [layer for layer in self.simulcast_layers if layer <= max_layer] or [min(self.simulcast_layers)]
+                
+                # Pace to the target FPS; the grabber keeps draining the camera meanwhile
+                delay = last_send + 1.0 / fps - time.time()
+                if delay > 0:
+                    time.sleep(delay)
+                
+                item = grabber.take(timeout=1.0)
+                if item is None:
+                    if grabber.failed:
                         print(f"⚠️ Camera read failed multiple times, stopping video")
                         self.video_streaming = False
                         break
-                    time.sleep(0.1)
-                    continue
-                
-                error_count = 0  # Reset on successful read
-                
-                # Resize and compress MORE to avoid UDP packet size limit (65507 bytes)
-                frame = cv2.resize(frame, (320, 240))
-                
-                # Try higher compression first
-                encode_param = [cv2.IMWRITE_JPEG_QUALITY, 40]  # Lower quality = smaller
-                _, buffer = cv2.imencode('.jpg', frame, encode_param)
-                
-                # Check size and reduce if needed
-                if len(buffer) > 60000:  # Safety margin
-                    encode_param = [cv2.IMWRITE_JPEG_QUALITY, 30]
-                    _, buffer = cv2.imencode('.jpg', frame, encode_param)
-                
-                if len(buffer) > 60000:  # Still too big, resize smaller
-                    frame = cv2.resize(frame, (240, 180))
-                    encode_param = [cv2.IMWRITE_JPEG_QUALITY, 40]
-                    _, buffer = cv2.imencode('.jpg', frame, encode_param)
-                
-                # Create packet: type(1) + username_len(1) + username + frame_data
-                username_bytes = self.username.encode('utf-8')
-                packet = bytes([1, len(username_bytes)]) + username_bytes + buffer.tobytes()
-                
-                # Final size check
-                if len(packet) > 65000:
-                    print(f"⚠️ Packet too large ({len(packet)} bytes), skipping frame")
                     continue
                 
-                # Send via UDP (using stored port, not GUI widget)
-                self.udp_socket.sendto(packet, (self.server_ip, self.server_udp_port))
+                # One packet per simulcast layer; the server forwards each
+                # receiver only the layer it asked for
+                own_jpeg = None
+                timestamp = media_clock()
+                for layer, jpeg in self.encode_simulcast_layers(*item, layers=layers, quality=quality):
+                    if self.send_media(STREAM_VIDEO, jpeg, layer, timestamp) and own_jpeg is None:
+                        own_jpeg = jpeg  # Largest layer sent
+                last_send = time.time()
                 
-                # Update own video (thread-safe) - resize back for display
-                display_frame = cv2.resize(frame, (320, 240))
-                self.video_frames[self.username] = display_frame.copy()
+                # Update own video (thread-safe) - decoded like any other stream
+                if own_jpeg:
+                    self.store_video_packet(self.username, own_jpeg)
                 
                 frame_count += 1
                 if frame_count % 90 == 0:  # Log every 90 frames (3 seconds)
                     print(f"📹 Sent {frame_count} video frames")
-                
-                time.sleep(0.033)  # ~30 FPS
             except Exception as e:
                 # Only print error once, not repeatedly
                 if frame_count % 30 == 0:
                     print(f"Video stream error: {e}")
                 time.sleep(0.1)
         
+        grabber.stop()
+        if not grabber.join(timeout=2.0):
+            print("⚠️ Camera read did not return")
         print(f"📹 Video stream stopped for {self.username}")
     
+    def send_media(self, stream_type, payload, layer=0, timestamp=None, level=LEVEL_SILENCE):
+        """Send one media payload (plus FEC parity when a group completes).
+
+        Video frames go out as MAX_FRAGMENT-sized fragments with consecutive
+        seqs, so receivers can NACK just the pieces they lost.
+        """
+        timestamp = media_clock() if timestamp is None else timestamp
+        if stream_type == STREAM_VIDEO:
+            fragments = [payload[i:i + MAX_FRAGMENT] for i in range(0, len(payload), MAX_FRAGMENT)] or [b'']
+        else:
+            fragments = [payload]
+        
+        # Final size check
+        if len(fragments) > 255 or len(fragments[0]) > 65000:
+            print(f"⚠️ Packet too large ({len(payload)} bytes), skipping frame")
+            return False
+        
+        # Send via UDP (using stored port, not GUI widget)
+        server_addr = (self.server_ip, self.server_udp_port)
+        send_socket = self.audio_socket if stream_type == STREAM_AUDIO else self.udp_socket
+        group_size = self.fec_group_sizes.get(stream_type)
+        for index, fragment in enumerate(fragments):
+            seq = self.next_media_seq(stream_type, layer)
+            send_socket.sendto(pack_media_packet(stream_type, self.username, fragment, layer, seq,
+                                                     timestamp, index, len(fragments), level), server_addr)
+            
+            if group_size:
+                encoder = self.fec_encoders.get((stream_type, layer))
+                if encoder is None:
+                    encoder = self.fec_encoders[(stream_type, layer)] = FecEncoder(group_size)
+                parity = encoder.add(seq, timestamp, fragment, index, len(fragments))
+                if parity:
+                    base_seq, parity_payload = parity
+                    send_socket.sendto(pack_media_packet(stream_type | FEC_FLAG, self.username,
+                                                             parity_payload, layer, base_seq), server_addr)
+        return True
+    
+    def next_media_seq(self, stream_type, layer=0):
+        """Sequence number for the next packet of a stream/layer"""
+        seq = self.media_seq.get((stream_type, layer), 0)
+        self.media_seq[(stream_type, layer)] = (seq + 1) & 0xFFFF
+        return seq
+    
+    def encode_simulcast_layers(self, is_jpeg, data, layers, quality=40):
+        """Yield (layer, jpeg) for each of layers, largest first"""
+        top_layer = max(self.simulcast_layers)
+        frame = None
+        for layer in sorted(layers, reverse=True):
+            # The grabber captures at the top layer's size. The camera's JPEG
+            # only stands in for the best operating point; once congestion
+            # control lowers the quality, the layer is re-encoded at it
+            if (layer == top_layer and is_jpeg and len(data) <= 60000
+                    and quality >= CongestionController.LADDER[0][2]):
+                # Camera's own JPEG: no decode/re-encode round trip
+                yield layer, data
+                continue
+            if frame is None:
+                frame = cv2.imdecode(np.frombuffer(data, np.uint8), cv2.IMREAD_COLOR) if is_jpeg else data
+            yield layer, self.encode_video_frame(frame, VIDEO_LAYERS[layer], quality)
+    
+    def encode_video_frame(self, frame, size=(320, 240), quality=40):
+        """JPEG-encode a camera frame at size, small enough for one UDP packet"""
+        # Resize and compress MORE to avoid UDP packet size limit (65507 bytes)
+        frame = cv2.resize(frame, size)
+        
+        # Try higher compression first
+        encode_param = [cv2.IMWRITE_JPEG_QUALITY, quality]  # Lower quality = smaller
+        _, buffer = cv2.imencode('.jpg', frame, encode_param)
+        
+        # Check size and reduce if needed
+        if len(buffer) > 60000:  # Safety margin
+            encode_param = [cv2.IMWRITE_JPEG_QUALITY, max(quality - 10, 10)]
+            _, buffer = cv2.imencode('.jpg', frame, encode_param)
+        
+        if len(buffer) > 60000:  # Still too big, resize smaller
+            frame = cv2.resize(frame, (size[0] * 3 // 4, size[1] * 3 // 4))
+            encode_param = [cv2.IMWRITE_JPEG_QUALITY, quality]
+            _, buffer = cv2.imencode('.jpg', frame, encode_param)
+        
+        return buffer.tobytes()
+    
     def toggle_audio(self):
         """Toggle audio streaming"""
         if not self.audio_streaming:
@@ -681,12 +1195,7 @@ class LANClient:
                     
                 data = self.audio_input_stream.read(2048, exception_on_overflow=False)
                 
-                # Create packet: type(2) + username_len + username + audio_data
-                username_bytes = self.username.encode('utf-8')
-                packet = bytes([2, len(username_bytes)]) + username_bytes + data
-                
-                # Send via UDP (using stored port, not GUI widget)
-                self.udp_socket.sendto(packet, (self.server_ip, self.server_udp_port))
+                self.send_media(STREAM_AUDIO, data, level=audio_level(data))
                 
                 packet_count += 1
                 # Log every 50 packets to confirm sending
@@ -738,11 +1247,11 @@ class LANClient:
                         img.save(buffer, format='JPEG', quality=60)
                         img_str = base64.b64encode(buffer.getvalue()).decode()
                         
-                        # Send to server
+                        # Send to server over the screen channel
                         self.send_message({
                             'type': 'screen_frame',
                             'frame': img_str
-                        })
+                        }, sock=self.screen_socket)
                         
                         frame_count += 1
                         if frame_count % 30 == 0:  # Log every 30 frames
@@ -784,6 +1293,10 @@ class LANClient:
         if filepath:
             try:
                 filename = os.path.basename(filepath)
+                # Base64 grows the file by a third; the server drops bigger frames
+                if os.path.getsize(filepath) * 4 // 3 + 4096 > MAX_FRAME:
+                    messagebox.showerror("Error", f"File is too large (limit {MAX_FRAME * 3 // 4 >> 20} MB)")
+                    return
                 with open(filepath, 'rb') as f:
                     filedata = base64.b64encode(f.read()).decode()
                 
@@ -819,7 +1332,7 @@ class LANClient:
         """Receive and process TCP messages from server"""
         while self.running and self.connected:
             try:
-                msg = self.recv_message()
+                msg = self.recv_message(idle_timeout=HEARTBEAT_TIMEOUT)
                 if not msg:
                     if self.running:  # Only print if we didn't intentionally close
                         print("Disconnected from server")
@@ -846,32 +1359,12 @@ class LANClient:
         if msg_type == 'chat':
             self.display_chat_message(msg)
         
-        elif msg_type == 'user_joined':
-            self.users = msg['users']
-            self.master.after(0, self.update_users_list)
-            self.display_chat_message({
-                'username': 'System',
-                'message': f"{msg['username']} joined the session",
-                'timestamp': datetime.now().strftime('%H:%M:%S')
-            })
+        elif msg_type == 'presence':
+            # Users list changes are applied in order on the main thread
+            self.master.after(0, self.apply_presence, msg)
         
-        elif msg_type == 'user_left':
-            self.users = msg['users']
-            self.master.after(0, self.update_users_list)
-            self.display_chat_message({
-                'username': 'System',
-                'message': f"{msg['username']} left the session",
-                'timestamp': datetime.now().strftime('%H:%M:%S')
-            })
-            
-            # Remove their video frame
-            if msg['username'] in self.video_frames:
-                del self.video_frames[msg['username']]
-            
-            # Clear presenter if they left
-            if self.presenter == msg['username']:
-                self.presenter = None
-                self.master.after(0, lambda: self.screen_label.config(text="No presentation active", image=''))
+        elif msg_type == 'presence_snapshot':
+            self.master.after(0, self.apply_presence_snapshot, msg)
         
         elif msg_type == 'presenter_changed':
             self.presenter = msg['presenter']
@@ -885,23 +1378,13 @@ class LANClient:
                 self.master.after(0, lambda: self.screen_label.config(text="No presentation active", image=''))
                 self.master.after(0, lambda: self.present_btn.config(text="🖥️ Start Presenting", state=tk.NORMAL))
         
-        elif msg_type == 'screen_frame':
-            if msg['presenter'] == self.presenter and msg['presenter'] != self.username:
-                # Display screen frame
-                try:
-                    img_data = base64.b64decode(msg['frame'])
-                    img = Image.open(io.BytesIO(img_data))
-                    
-                    # Resize to fit display area
-                    display_width = 800
-                    display_height = 600
-                    img.thumbnail((display_width, display_height), Image.LANCZOS)
-                    
-                    photo = ImageTk.PhotoImage(img)
-                    # Update GUI in main thread
-                    self.master.after(0, lambda p=photo: self._update_screen_display(p))
-                except Exception as e:
-                    print(f"Screen frame display error: {e}")
+        elif msg_type == 'active_speakers':
+            # Picked up by the next video grid update
+            self.active_speakers = msg['speakers']
+        
+        elif msg_type == 'receiver_report':
+            # Feedback about our own video from one receiver
+            self.congestion.on_report(msg)
         
         elif msg_type == 'file_available':
             # Add file to listbox
@@ -930,138 +1413,452 @@ class LANClient:
             except Exception as e:
                 messagebox.showerror("Error", f"Download failed: {e}")
     
-    def receive_udp_streams(self):
-        """Receive UDP video and audio streams"""
+    def receive_screen_frames(self):
+        """Receive screen frames from the dedicated screen channel"""
         while self.running and self.connected:
             try:
-                data, addr = self.udp_socket.recvfrom(65535)
-                
-                if len(data) < 2:
-                    continue
-                
-                stream_type = data[0]  # 1=video, 2=audio
-                username_len = data[1]
+                msg = self.recv_message(self.screen_reader)
+                if not msg:
+                    break
                 
-                if len(data) < 2 + username_len:
-                    continue
+                # Framing and dispatch only: decoding happens on the worker,
+                # which always picks up the newest frame
+                if msg.get('type') == 'screen_frame':
+                    if msg['presenter'] == self.presenter and msg['presenter'] != self.username:
+                        self.screen_frame_slot.put(msg)
+            except Exception as e:
+                if self.running:
+                    print(f"Screen channel receive error: {e}")
+                break
+    
+    def decode_screen_frames(self):
+        """Decode screen frames off the network and UI threads (latest frame wins)"""
+        while self.running and self.connected:
+            msg = self.screen_frame_slot.take(timeout=1.0)
+            if msg is None:
+                continue
+            try:
+                img_data = base64.b64decode(msg['frame'])
+                img = Image.open(io.BytesIO(img_data))
                 
-                username = data[2:2+username_len].decode('utf-8')
-                payload = data[2+username_len:]
+                # Resize to fit display area
+                display_width = 800
+                display_height = 600
+                img.thumbnail((display_width, display_height), Image.LANCZOS)
                 
-                if stream_type == 1:  # Video
-                    # Decode video frame (in background thread is OK)
-                    try:
-                        nparr = np.frombuffer(payload, np.uint8)
-                        frame = cv2.imdecode(nparr, cv2.IMREAD_COLOR)
-                        if frame is not None:
-                            # Just store the frame, GUI will display it
-                            self.video_frames[username] = frame.copy()
-                    except Exception as e:
-                        pass  # Silently skip bad frames
+                # Hand a ready RGB buffer to the main thread, which owns Tk objects
+                self.screen_image_slot.put(img.convert('RGB'))
+                self.master.after(0, self._update_screen_display)
+            except Exception as e:
+                print(f"Screen frame display error: {e}")
+    
+    def receive_udp_streams(self):
+        """Receive UDP video and audio streams (unicast and multicast)"""
+        last_nack_check = 0
+        while self.running and self.connected:
+            try:
+                now = time.time()
+                if now - last_nack_check >= NACK_CHECK_INTERVAL:
+                    last_nack_check = now
+                    self.send_nacks(now)
+                    self.expire_audio_playout(now)
                 
-                elif stream_type == 2:  # Audio
-                    # Play audio (can be done in background thread)
-                    try:
-                        if self.audio_output_stream and self.audio_streaming:
-                            # Only play audio from others, not ourselves
-                            if username != self.username:
-                                # Log occasionally for debugging
-                                if not hasattr(self, '_audio_packet_count'):
-                                    self._audio_packet_count = {}
-                                
-                                if username not in self._audio_packet_count:
-                                    self._audio_packet_count[username] = 0
-                                
-                                self._audio_packet_count[username] += 1
-                                
-                                # Log every 50 packets
-                                if self._audio_packet_count[username] % 50 == 0:
-                                    print(f"🔊 Received {self._audio_packet_count[username]} audio packets from {username}")
-                                
-                                self.audio_output_stream.write(payload, exception_on_underflow=False)
-                    except Exception as e:
-                        # Log audio playback errors occasionally
-                        if not hasattr(self, '_audio_error_logged'):
-                            self._audio_error_logged = True
-                            print(f"⚠️ Audio playback error: {e}")
+                # Wake up regularly so missing fragments get NACKed even when
+                # the stream goes quiet right after a loss
+                sockets = [self.udp_socket]
+                if self.multicast_socket:
+                    sockets.append(self.multicast_socket)
+                readable, _, _ = select.select(sockets, [], [], NACK_CHECK_INTERVAL)
+                for sock in readable:
+                    data, addr = sock.recvfrom(65535)
+                    self.handle_datagram(data, sock is not self.udp_socket)
             
             except Exception as e:
                 if self.running:
                     pass  # Silently handle UDP errors
     
+    def handle_datagram(self, data, multicast=False):
+        """Parse one received datagram and deliver its media"""
+        packet = parse_media_packet(data)
+        if packet is None:
+            return
+        
+        if multicast:
+            if packet.stream_type == STREAM_PROBE:
+                # The server's proof that the group reaches us
+                if packet.username == self.username and not self.multicast_confirmed:
+                    token = packet.payload.decode()
+                    self.master.after(0, self.confirm_multicast, token)
+                return
+            # The group carries everyone's media, including ours and layers
+            # meant for other receivers; anyone not in our room is another
+            # room's traffic on a reused group
+            if not self.multicast_confirmed or packet.username == self.username:
+                return
+            if packet.username not in self.users:
+                return
+            if packet.stream_type & ~FEC_FLAG == STREAM_VIDEO and not self.multicast_layer_wanted(packet):
+                return
+        
+        fec_key = (packet.username, packet.stream_type & ~FEC_FLAG, packet.layer)
+        if packet.stream_type & FEC_FLAG:
+            # Parity: rebuild the group's single missing packet, if any
+            decoder = self.fec_decoders.get(fec_key)
+            if decoder is None:
+                decoder = self.fec_decoders[fec_key] = FecDecoder()
+            if fec_key[1] == STREAM_AUDIO and fec_key not in self.audio_playout and packet.payload:
+                # Hold audio back across a gap for as long as parity can fill it
+                depth = packet.payload[0] + 1
+                self.audio_playout[fec_key] = PlayoutBuffer(depth, max_wait=depth * AUDIO_CHUNK_SECONDS)
+            packet = decoder.recover(packet)
+            if packet is None:
+                return
+        else:
+            if fec_key in self.fec_decoders:
+                self.fec_decoders[fec_key].add(packet)
+            if packet.stream_type == STREAM_VIDEO:
+                self.record_video_arrival(packet, len(data))
+        
+        playout = self.audio_playout.get(fec_key)
+        if playout is None:
+            self.handle_media_packet(packet)
+            return
+        for due in playout.add(packet):
+            self.handle_media_packet(due)
+    
+    def expire_audio_playout(self, now):
+        """Play audio held back by a gap whose parity never came"""
+        for playout in list(self.audio_playout.values()):
+            for due in playout.expire(now):
+                self.handle_media_packet(due)
+    
+    def multicast_layer_wanted(self, packet):
+        """Apply the server's simulcast layer choice to video taken from the group"""
+        now = time.time()
+        self.multicast_layers[(packet.username, packet.layer)] = now
+        requested = self.requested_layers.get(packet.username, DEFAULT_VIDEO_LAYER)
+        if self.active_speakers and packet.username not in self.active_speakers:
+            requested = 0  # Same cap the server applies to non-speakers
+        published = [layer for (sender, layer), seen in self.multicast_layers.items()
+                     if sender == packet.username and now - seen < LAYER_TIMEOUT]
+        return packet.layer == select_layer(requested, published)
+    
+    def confirm_multicast(self, token):
+        """Tell the server the probe arrived so it stops unicasting our media"""
+        if self.multicast_confirmed or not self.multicast_socket:
+            return
+        self.multicast_confirmed = True
+        self.send_message({'type': 'multicast_ok', 'token': token})
+        print("Receiving room media by multicast")
+    
+    def handle_media_packet(self, packet):
+        """Deliver a received (or FEC-recovered) media packet"""
+        username = packet.username
+        payload = packet.payload
+        
+        if packet.stream_type == STREAM_VIDEO:
+            key = (username, packet.layer)
+            assembler = self.frame_assemblers.get(key)
+            if assembler is None:
+                assembler = self.frame_assemblers[key] = FrameAssembler()
+            frame = assembler.add(packet, time.time())
+            if frame is not None:
+                # Keep only the newest compressed frame, decoded on demand
+                self.store_video_packet(username, frame)
+        
+        elif packet.stream_type == STREAM_AUDIO:
+            # Play audio (can be done in background thread)
+            try:
+                if self.audio_output_stream and self.audio_streaming:
+                    # Only play audio from others, not ourselves
+                    if username != self.username:
+                        # Log occasionally for debugging
+                        if not hasattr(self, '_audio_packet_count'):
+                            self._audio_packet_count = {}
+                        
+                        if username not in self._audio_packet_count:
+                            self._audio_packet_count[username] = 0
+                        
+                        self._audio_packet_count[username] += 1
+                        
+                        # Log every 50 packets
+                        if self._audio_packet_count[username] % 50 == 0:
+                            print(f"🔊 Received {self._audio_packet_count[username]} audio packets from {username}")
+                        
+                        self.audio_output_stream.write(payload, exception_on_underflow=False)
+            except Exception as e:
+                # Log audio playback errors occasionally
+                if not hasattr(self, '_audio_error_logged'):
+                    self._audio_error_logged = True
+                    print(f"⚠️ Audio playback error: {e}")
+    
+    def send_nacks(self, now):
+        """Ask the server to resend fragments missing from partly received frames"""
+        server_addr = (self.server_ip, self.server_udp_port)
+        for (sender, layer), assembler in list(self.frame_assemblers.items()):
+            seqs = assembler.missing(now)
+            if seqs:
+                try:
+                    self.udp_socket.sendto(pack_nack(self.username, sender, layer, seqs[:255]), server_addr)
+                except OSError:
+                    pass
+    
+    def record_video_arrival(self, packet, size):
+        """Update receive counters and interarrival jitter (RFC 3550) for a sender"""
+        transit = (int(time.time() * 1000) - packet.timestamp) & 0xFFFFFFFF
+        with self.receive_stats_lock:
+            stats = self.receive_stats.setdefault(packet.username, {'received': 0, 'bytes': 0})
+            stats['received'] += 1
+            stats['bytes'] += size
+            
+            # Fragments of one frame share its timestamp, so jitter is
+            # measured on first fragments only
+            if packet.frag_index:
+                return
+            state = self.receive_jitter.setdefault(packet.username, [0.0, transit])
+            delta = abs(transit - state[1])
+            if delta < 0x80000000:  # Ignore clock wrap
+                state[0] += (delta - state[0]) / 16
+            state[1] = transit
+    
+    def send_heartbeat(self):
+        """Tell the server we are still here - main thread timer"""
+        if not self.running or not self.connected:
+            return
+        self.send_message({'type': 'heartbeat'})
+        self.master.after(int(HEARTBEAT_INTERVAL * 1000), self.send_heartbeat)
+    
+    def send_receiver_reports(self):
+        """Report what arrived since the last report - main thread timer"""
+        if not self.running or not self.connected:
+            return
+        
+        now = time.time()
+        with self.receive_stats_lock:
+            stats, self.receive_stats = self.receive_stats, {}
+            reports = {sender: {'received': s['received'],
+                                'bytes': s['bytes'],
+                                'jitter': round(self.receive_jitter.get(sender, [0.0])[0], 1)}
+                       for sender, s in stats.items()}
+        
+        # Sent even when nothing arrived, so total loss is still detected
+        self.send_message({
+            'type': 'receiver_report',
+            'interval': now - self.last_report_time,
+            'reports': reports
+        })
+        self.last_report_time = now
+        self.master.after(int(REPORT_INTERVAL * 1000), self.send_receiver_reports)
+    
     def update_users_list(self):
         """Update the users listbox"""
         self.users_listbox.delete(0, tk.END)
         for user in self.users:
-            display_name = f"{user} (You)" if user == self.username else user
-            self.users_listbox.insert(tk.END, display_name)
+            self.users_listbox.insert(tk.END, self.user_display_name(user))
+    
+    def user_display_name(self, user):
+        return f"{user} (You)" if user == self.username else user
+    
+    def apply_presence(self, msg):
+        """Apply a numbered presence delta entry by entry - main thread"""
+        if msg['version'] <= self.presence_version:
+            return  # Already part of the snapshot we hold
+        if msg['version'] != self.presence_version + 1:
+            # Missed a delta: ask for the full list once and drop deltas until it arrives
+            if not self.presence_resyncing:
+                self.presence_resyncing = True
+                self.send_message({'type': 'presence_resync'})
+            return
+        self.presence_version = msg['version']
+        for user in msg['left']:
+            if user in self.users:
+                index = self.users.index(user)
+                del self.users[index]
+                self.users_listbox.delete(index)
+                self.user_left(user)
+        for user in msg['joined']:
+            if user not in self.users:
+                self.users.append(user)
+                self.users_listbox.insert(tk.END, self.user_display_name(user))
+                self.display_chat_message({
+                    'username': 'System',
+                    'message': f"{user} joined the session",
+                    'timestamp': datetime.now().strftime('%H:%M:%S')
+                })
     
-    def _update_screen_display(self, photo):
+    def apply_presence_snapshot(self, msg):
+        """Replace the users list after a resync - main thread"""
+        self.presence_resyncing = False
+        if msg['version'] < self.presence_version:
+            return
+        for user in self.users:
+            if user not in msg['users']:
+                self.user_left(user)
+        self.users = msg['users']
+        self.presence_version = msg['version']
+        self.update_users_list()
+    
+    def user_left(self, username):
+        """Announce a departure and drop the user's media state"""
+        self.display_chat_message({
+            'username': 'System',
+            'message': f"{username} left the session",
+            'timestamp': datetime.now().strftime('%H:%M:%S')
+        })
+        
+        # Remove their video frame
+        self.remove_video_stream(username)
+        for key in list(self.fec_decoders):
+            if key[0] == username:
+                self.fec_decoders.pop(key, None)
+                self.audio_playout.pop(key, None)
+        for key in list(self.frame_assemblers):
+            if key[0] == username:
+                self.frame_assemblers.pop(key, None)
+        
+        # Clear presenter if they left
+        if self.presenter == username:
+            self.presenter = None
+            self.screen_label.config(text="No presentation active", image='')
+    
+    def _update_screen_display(self):
         """Update screen display in main thread"""
+        img = self.screen_image_slot.take(timeout=0)
+        if img is None or not self.presenter or self.presenter == self.username:
+            return
         try:
+            photo = self.screen_photo
+            if photo and (photo.width(), photo.height()) == img.size:
+                # Same size: update the existing image in place
+                photo.paste(img)
+            else:
+                photo = ImageTk.PhotoImage(img)
+                self.screen_photo = photo
             self.screen_label.config(image=photo, text='')
             self.screen_label.image = photo  # Keep reference
         except:
             pass
     
+    def store_video_packet(self, username, payload):
+        """Publish a new compressed frame for a user, replacing any undecoded one"""
+        self.video_packets[username] = payload
+        self.video_packet_versions[username] = self.video_packet_versions.get(username, 0) + 1
+    
+    def remove_video_stream(self, username):
+        """Forget all video state for a user"""
+        self.video_packets.pop(username, None)
+        self.video_packet_versions.pop(username, None)
+        self.video_frames.pop(username, None)
+        self.video_frame_versions.pop(username, None)
+        self.video_source_sizes.pop(username, None)
+    
+    def choose_video_layer(self):
+        """Smallest simulcast layer that fills a grid tile - main thread"""
+        cell = self.video_tiles.cell_size()
+        if not cell:
+            return None
+        for layer, (width, height) in enumerate(VIDEO_LAYERS):
+            if width >= cell[0] or height >= cell[1]:
+                return layer
+        return len(VIDEO_LAYERS) - 1
+    
+    def request_video_layers(self, usernames):
+        """Tell the server which layer to forward for each sender, on change only"""
+        layer = self.choose_video_layer()
+        if layer is None:
+            return
+        for username in usernames:
+            if username != self.username and self.requested_layers.get(username) != layer:
+                self.requested_layers[username] = layer
+                self.send_message({
+                    'type': 'video_layer',
+                    'sender': username,
+                    'layer': layer
+                })
+    
+    def choose_decode_scale(self, username):
+        """Pick the largest JPEG downscale that still fills the tile - main thread"""
+        cell = self.video_tiles.cell_size()
+        source = self.video_source_sizes.get(username)
+        if not cell or not source:
+            return 1
+        
+        chosen = 1
+        for scale, _ in DECODE_SCALES:
+            if source[0] // scale >= cell[0] or source[1] // scale >= cell[1]:
+                chosen = scale
+            else:
+                break
+        return chosen
+    
+    def request_video_decode(self, username):
+        """Queue a decode of the user's newest packet if it has not been decoded yet"""
+        version = self.video_packet_versions.get(username)
+        if version is None or version == self.video_frame_versions.get(username):
+            return
+        if username in self.video_decoding:
+            return  # The in-flight decode is re-checked when it finishes
+        payload = self.video_packets.get(username)
+        if payload is None:
+            return
+        self.video_decoding.add(username)
+        scale = self.choose_decode_scale(username)
+        self.video_decode_pool.submit(self.decode_video_frame, username, version, payload, scale)
+    
+    def decode_video_frame(self, username, version, payload, scale=1):
+        """Decode one compressed frame on a pool worker, straight to display size and RGB"""
+        try:
+            flag = dict(DECODE_SCALES)[scale]
+            frame = cv2.imdecode(np.frombuffer(payload, np.uint8), flag)
+            if frame is not None and username in self.video_packets:
+                height, width = frame.shape[:2]
+                self.video_source_sizes[username] = (width * scale, height * scale)
+                rgb_frame = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
+                # Frame before version: readers check the version first
+                self.video_frames[username] = rgb_frame
+                self.video_frame_versions[username] = version
+        except Exception as e:
+            pass  # Silently skip bad frames
+        finally:
+            self.video_decoding.discard(username)
+        
+        if self.running:
+            self.master.after(0, self.update_video_tile, username)
+    
+    def update_video_tile(self, username):
+        """Show a user's newest decoded frame if the tile is behind - main thread"""
+        # Version first: the frame stored for it is then at least as new
+        version = self.video_frame_versions.get(username)
+        if version is None or version == self.video_tiles.version(username):
+            return
+        frame = self.video_frames.get(username)
+        if frame is None:
+            return
+        try:
+            self.video_tiles.update_image(username, Image.fromarray(frame), version)
+        except Exception as e:
+            # Silently skip this frame, will try again in next update
+            pass
+    
     def update_video_grid(self):
         """Update video display grid - MUST run in main thread"""
         if not self.running or not self.connected:
             return
         
         try:
-            # Clear existing video labels
-            for widget in self.video_container.winfo_children():
-                widget.destroy()
+            # Tiles change only when participants start/stop video or leave,
+            # or when the active speakers change: they move to the front
+            speakers = [u for u in self.active_speakers if u in self.video_packets]
+            usernames = speakers + [u for u in self.video_packets if u not in speakers]
+            self.video_tiles.sync(usernames)
+            self.video_tiles.highlight(speakers, self.colors['accent_green'])
+            self.request_video_layers(usernames)
             
-            # Create grid for video frames
-            num_videos = len(self.video_frames)
-            if num_videos == 0:
-                label = tk.Label(self.video_container, text="No active video streams", 
-                               anchor=tk.CENTER, bg='gray20', fg='white')
-                label.pack(expand=True, fill=tk.BOTH)
-                self.master.after(200, self.update_video_grid)
-                return
-            
-            # Calculate grid dimensions
-            cols = min(3, num_videos)
-            rows = (num_videos + cols - 1) // cols
-            
-            for i, (username, frame) in enumerate(list(self.video_frames.items())):
-                row = i // cols
-                col = i % cols
-                
-                try:
-                    # Create frame container
-                    video_frame = tk.Frame(self.video_container, relief=tk.SOLID, 
-                                         borderwidth=2, bg='black')
-                    video_frame.grid(row=row, column=col, padx=5, pady=5, sticky='nsew')
-                    
-                    # Username label
-                    name_label = tk.Label(video_frame, text=username, bg='black', 
-                                        fg='white', font=('Arial', 10, 'bold'))
-                    name_label.pack(side=tk.TOP, pady=2)
-                    
-                    # Video display
-                    # Convert BGR to RGB
-                    frame_copy = frame.copy()
-                    rgb_frame = cv2.cvtColor(frame_copy, cv2.COLOR_BGR2RGB)
-                    img = Image.fromarray(rgb_frame)
-                    photo = ImageTk.PhotoImage(img)
-                    
-                    video_label = tk.Label(video_frame, image=photo, bg='black')
-                    video_label.image = photo  # Keep reference
-                    video_label.pack(expand=True, fill=tk.BOTH)
-                    
-                except Exception as e:
-                    # Silently skip this frame, will try again in next update
-                    pass
-            
-            # Configure grid weights for responsive layout
-            for i in range(cols):
-                self.video_container.grid_columnconfigure(i, weight=1)
-            for i in range(rows):
-                self.video_container.grid_rowconfigure(i, weight=1)
+            # Decode only what is about to be displayed: one newest frame per
+            # sender per tick, however fast packets arrive
+            for username in usernames:
+                self.request_video_decode(username)
+                self.update_video_tile(username)
             
         except Exception as e:
             # Silently handle errors
@@ -1077,6 +1874,9 @@ class LANClient:
             self.audio_streaming = False
             self.presenting = False
             self.running = False
+            self.screen_frame_slot.close()
+            self.screen_image_slot.close()
+            self.video_decode_pool.shutdown(wait=False)
             
             # Wait a moment for threads to stop
             time.sleep(0.3)
@@ -1098,6 +1898,21 @@ class LANClient:
                     self.udp_socket.close()
                 except:
                     pass
+            if self.audio_socket:
+                try:
+                    self.audio_socket.close()
+                except:
+                    pass
+            if self.multicast_socket:
+                try:
+                    self.multicast_socket.close()
+                except:
+                    pass
+            if self.screen_socket:
+                try:
+                    self.screen_socket.close()
+                except:
+                    pass
         else:
             self.running = False
         
@@ -1106,7 +1921,21 @@ class LANClient:
         except:
             pass
 if __name__ == "__main__":
+    import sys
     import tkinter as tk
+    
+    # Optional: python client.py --max-fps 5 --fec-video 4 --fec-audio 5
+    max_video_fps = None
+    if '--max-fps' in sys.argv:
+        max_video_fps = float(sys.argv[sys.argv.index('--max-fps') + 1])
+    fec_group_sizes = {}
+    for option, stream_type in (('--fec-video', STREAM_VIDEO), ('--fec-audio', STREAM_AUDIO)):
+        if option in sys.argv:
+            group_size = int(sys.argv[sys.argv.index(option) + 1])
+            if not FEC_MIN_GROUP <= group_size <= FEC_MAX_GROUP:
+                sys.exit(f"{option} takes a group size from {FEC_MIN_GROUP} to {FEC_MAX_GROUP}")
+            fec_group_sizes[stream_type] = group_size
+    
     root = tk.Tk()
-    client_app = LANClient(root)
+    client_app = LANClient(root, max_video_fps=max_video_fps, fec_group_sizes=fec_group_sizes)
     root.mainloop()
@@ -0,0 +1,590 @@
+#!/usr/bin/env python3
+"""
+Shared helpers used by both the LAN server and client
+"""
+
+import json
+import socket
+import struct
+import threading
+import time
+import zlib
+from collections import namedtuple
+
+# UDP media stream types
+STREAM_VIDEO = 1
+STREAM_AUDIO = 2
+STREAM_NACK = 3  # Receiver -> server: resend these video fragments
+STREAM_PROBE = 4  # Server -> multicast group: proves a client receives the group
+
+# Video frames are split into fragments of at most this many payload bytes,
+# so a single lost datagram costs one fragment instead of a whole frame
+MAX_FRAGMENT = 1200
+
+# Simulcast spatial layers, lowest first: index -> (width, height)
+VIDEO_LAYERS = ((160, 120), (320, 240), (640, 480))
+DEFAULT_VIDEO_LAYER = 1
+
+# A simulcast layer counts as published while packets arrive this often
+LAYER_TIMEOUT = 0.5
+
+# Fields after the username: layer(1) + seq(2) + timestamp(4, sender ms clock)
+# + fragment index(1) + fragment count(1) + audio level(1)
+MEDIA_FIELDS = struct.Struct('>BHIBBB')
+
+# Audio levels are -dBov as in RFC 6464: 0 is the loudest, 127 silence
+LEVEL_SILENCE = 127
+
+# IP TOS bytes for media sockets: DSCP EF (46) for voice, AF41 (34) for video
+TOS_AUDIO = 0xB8
+TOS_VIDEO = 0x88
+
+# Control connections carry a heartbeat this often (seconds), and an end
+# that hears nothing for HEARTBEAT_TIMEOUT treats the other as gone
+HEARTBEAT_INTERVAL = 2.0
+HEARTBEAT_TIMEOUT = 6.0
+
+# A TCP send that makes no progress this long marks its connection dead
+SEND_TIMEOUT = 2.0
+
+# Largest TCP frame payload accepted (a base64 file upload is the biggest);
+# a length prefix above it drops the connection
+MAX_FRAME = 64 << 20
+
+# TCP messages may be zlib-compressed once both ends agreed at register.
+# Bit 31 of the length prefix marks a compressed payload; only messages of
+# at least COMPRESS_THRESHOLD bytes are tried, and the result is only used
+# if it is at most COMPRESS_MAX_RATIO of the original
+COMPRESSED_FLAG = 0x80000000
+COMPRESS_THRESHOLD = 1024
+COMPRESS_MAX_RATIO = 0.9
+COMPRESS_LEVEL = 1  # Fastest; JSON text still shrinks several times
+UNCOMPRESSED_TYPES = ('screen_frame',)  # Base64 JPEG, barely compressible
+
+# Set on the type byte of XOR parity packets (see FecEncoder)
+FEC_FLAG = 0x80
+
+# Packets per parity group; the size travels in one byte, and one packet
+# per group would just send everything twice
+FEC_MIN_GROUP = 2
+FEC_MAX_GROUP = 255
+
+# Parity payload header: group size(1); each protected packet contributes
+# length(2) + timestamp(4) + frag_index(1) + frag_count(1) + payload to the XOR
+FEC_ENTRY = struct.Struct('>HIBB')
+
+MediaPacket = namedtuple('MediaPacket', 'stream_type username layer seq timestamp frag_index frag_count level payload')
+
+
+def encode_message(msg, compress=False, stats=None):
+    """Serialize msg into a length-prefixed JSON frame ready for sendall.
+
+    The result is immutable, so a broadcast can encode once and hand the
+    same buffer to every recipient. With compress, large messages are
+    zlib-compressed when that pays off, and the attempt is added to stats
+    (a CompressionStats).
+    """
+    data = json.dumps(msg).encode('utf-8')
+    if compress and len(data) >= COMPRESS_THRESHOLD and msg.get('type') not in UNCOMPRESSED_TYPES:
+        start = time.thread_time()
+        packed = zlib.compress(data, COMPRESS_LEVEL)
+        used = len(packed) <= len(data) * COMPRESS_MAX_RATIO
+        if stats:
+            stats.record(len(data), len(packed) if used else len(data), time.thread_time() - start)
+        if used:
+            return struct.pack('>I', len(packed) | COMPRESSED_FLAG) + packed
+    return struct.pack('>I', len(data)) + data
+
+
+def decode_message(frame):
+    """Parse the payload of a frame produced by encode_message"""
+    return json.loads(str(frame, 'utf-8'))
+
+
+class CompressionStats:
+    """Totals over every message encode_message tried to compress"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.messages = 0  # Compression attempts
+        self.compressed = 0  # Attempts that were sent compressed
+        self.raw_bytes = 0
+        self.sent_bytes = 0
+        self.cpu_time = 0.0
+
+    def record(self, raw_bytes, sent_bytes, cpu_time):
+        with self.lock:
+            self.messages += 1
+            self.compressed += sent_bytes < raw_bytes
+            self.raw_bytes += raw_bytes
+            self.sent_bytes += sent_bytes
+            self.cpu_time += cpu_time
+
+    def snapshot(self):
+        """JSON-ready totals, with the overall ratio (sent / original bytes)"""
+        with self.lock:
+            return {
+                'messages': self.messages,
+                'compressed': self.compressed,
+                'raw_bytes': self.raw_bytes,
+                'sent_bytes': self.sent_bytes,
+                'ratio': round(self.sent_bytes / self.raw_bytes, 3) if self.raw_bytes else None,
+                'cpu_ms': round(self.cpu_time * 1000, 1)
+            }
+
+
+def send_all(sock, data):
+    """sendall() for sockets with a timeout, where the timeout limits each
+    stall rather than the whole transfer: a large file still goes out over a
+    slow link, but a peer that stops reading raises socket.timeout"""
+    view = memoryview(data)
+    while view:
+        view = view[sock.send(view):]
+
+
+def set_dscp(sock, tos):
+    """Mark packets sent from sock with a TOS/DSCP byte so LAN switches can
+    prioritize them; returns False where the OS does not allow it"""
+    try:
+        sock.setsockopt(socket.IPPROTO_IP, socket.IP_TOS, tos)
+        return True
+    except (AttributeError, OSError):
+        return False
+
+
+def media_clock():
+    """Sender timestamp for media packets: milliseconds, wrapping at 32 bits"""
+    return int(time.time() * 1000) & 0xFFFFFFFF
+
+
+def pack_media_packet(stream_type, username, payload, layer=0, seq=0, timestamp=0,
+                      frag_index=0, frag_count=1, level=LEVEL_SILENCE):
+    """Build a UDP media datagram.
+
+    Layout: type(1) + username_len(1) + username + layer(1) + seq(2)
+    + timestamp(4) + frag_index(1) + frag_count(1) + level(1) + payload.
+    seq counts per (stream type, layer); fragments of a frame share its
+    timestamp and have consecutive seqs. level is only meaningful for audio.
+    """
+    username_bytes = username.encode('utf-8')
+    return (bytes((stream_type, len(username_bytes))) + username_bytes
+            + MEDIA_FIELDS.pack(layer, seq & 0xFFFF, timestamp, frag_index, frag_count, level) + payload)
+
+
+def parse_media_packet(data):
+    """Split a UDP media datagram into a MediaPacket, None if malformed"""
+    if len(data) < 2:
+        return None
+    username_len = data[1]
+    fields_at = 2 + username_len
+    header_len = fields_at + MEDIA_FIELDS.size
+    if len(data) < header_len:
+        return None
+    try:
+        username = data[2:fields_at].decode('utf-8')
+    except UnicodeDecodeError:
+        return None
+    layer, seq, timestamp, frag_index, frag_count, level = MEDIA_FIELDS.unpack_from(data, fields_at)
+    return MediaPacket(data[0], username, layer, seq, timestamp, frag_index, frag_count, level,
+                       data[header_len:])
+
+
+def pack_nack(receiver, sender, layer, seqs):
+    """Build a NACK datagram asking the server to resend sender's fragments"""
+    sender_bytes = sender.encode('utf-8')
+    payload = bytes((len(sender_bytes),)) + sender_bytes + struct.pack(f'>{len(seqs)}H', *seqs)
+    return pack_media_packet(STREAM_NACK, receiver, payload, layer)
+
+
+def parse_nack(payload):
+    """Return (sender, [seq, ...]) from a NACK payload, None if malformed"""
+    if not payload:
+        return None
+    sender_end = 1 + payload[0]
+    count = (len(payload) - sender_end) // 2
+    if count < 0:
+        return None
+    try:
+        sender = payload[1:sender_end].decode('utf-8')
+    except UnicodeDecodeError:
+        return None
+    return sender, list(struct.unpack_from(f'>{count}H', payload, sender_end))
+
+
+def select_layer(requested, published):
+    """Simulcast layer to deliver: the highest published layer not above the
+    requested one, or the lowest published layer if all are above it"""
+    if not published:
+        return requested
+    below = [layer for layer in published if layer <= requested]
+    return max(below) if below else min(published)
+
+
+def seq_newer(a, b):
+    """True if 16-bit sequence number a comes after b (with wrap-around)"""
+    return a != b and ((a - b) & 0xFFFF) < 0x8000
+
+
+def timestamp_newer(a, b):
+    """True if 32-bit media timestamp a comes after b (with wrap-around)"""
+    return a != b and ((a - b) & 0xFFFFFFFF) < 0x80000000
+
+
+def _xor_bytes(a, b):
+    """XOR two byte strings, zero-padding the shorter one"""
+    size = max(len(a), len(b))
+    value = int.from_bytes(a.ljust(size, b'\0'), 'big') ^ int.from_bytes(b.ljust(size, b'\0'), 'big')
+    return value.to_bytes(size, 'big')
+
+
+class FecEncoder:
+    """Produces one XOR parity payload per group of consecutive packets.
+
+    The parity packet is sent with FEC_FLAG set on the stream type and the
+    group's first sequence number, so a receiver holding all but one
+    packet of the group can rebuild the missing one.
+    """
+    
+    def __init__(self, group_size):
+        if not FEC_MIN_GROUP <= group_size <= FEC_MAX_GROUP:
+            raise ValueError(f"FEC group size must be {FEC_MIN_GROUP}..{FEC_MAX_GROUP}, not {group_size}")
+        self.group_size = group_size
+        self.base_seq = None
+        self.count = 0
+        self.parity = b''
+    
+    def add(self, seq, timestamp, payload, frag_index=0, frag_count=1):
+        """Account for a sent packet; returns (base_seq, parity_payload) when a group completes"""
+        if self.count == 0:
+            self.base_seq = seq
+            self.parity = b''
+        self.parity = _xor_bytes(self.parity, FEC_ENTRY.pack(len(payload), timestamp, frag_index, frag_count)
+                                 + payload)
+        self.count += 1
+        
+        if self.count < self.group_size:
+            return None
+        self.count = 0
+        return self.base_seq, bytes((self.group_size,)) + self.parity
+
+
+class FecDecoder:
+    """Rebuilds a single lost packet per parity group for one stream.
+
+    Parity only arrives after the last packet of its group, so a rebuilt
+    packet is usually older than the newest one received. Video fragments
+    go to the FrameAssembler as usual; audio goes through a PlayoutBuffer
+    that holds the stream back until the gap is filled.
+    """
+    
+    def __init__(self, history=32):
+        self.history = history
+        self.received = {}  # {seq: entry bytes as XORed into the parity}
+        self.newest_seq = None
+    
+    def add(self, packet):
+        """Record a received data packet"""
+        self.received[packet.seq] = (FEC_ENTRY.pack(len(packet.payload), packet.timestamp,
+                                                    packet.frag_index, packet.frag_count)
+                                     + packet.payload)
+        if self.newest_seq is None or seq_newer(packet.seq, self.newest_seq):
+            self.newest_seq = packet.seq
+        if len(self.received) > self.history:
+            # Drop the oldest half; dicts keep insertion order
+            for seq in list(self.received)[:self.history // 2]:
+                del self.received[seq]
+    
+    def recover(self, parity_packet):
+        """Return the rebuilt MediaPacket for a parity packet, or None"""
+        payload = parity_packet.payload
+        if not payload:
+            return None
+        group_size = payload[0]
+        group = [(parity_packet.seq + i) & 0xFFFF for i in range(group_size)]
+        missing = [seq for seq in group if seq not in self.received]
+        if len(missing) != 1:
+            return None
+        
+        seq = missing[0]
+        data = payload[1:]
+        for other in group:
+            if other != seq:
+                data = _xor_bytes(data, self.received[other])
+        length, timestamp, frag_index, frag_count = FEC_ENTRY.unpack_from(data)
+        recovered = MediaPacket(parity_packet.stream_type & ~FEC_FLAG, parity_packet.username,
+                                parity_packet.layer, seq, timestamp, frag_index, frag_count,
+                                LEVEL_SILENCE, data[FEC_ENTRY.size:FEC_ENTRY.size + length])
+        self.add(recovered)
+        return recovered
+
+
+class PlayoutBuffer:
+    """Releases one audio stream in seq order, waiting out gaps FEC can fill.
+
+    Packets play as soon as everything before them has played, so a clean
+    stream sees no added delay. A missing packet holds the stream back until
+    it is rebuilt, until depth newer packets show its parity is not coming,
+    or until max_wait seconds pass. Packets older than the playout point
+    are dropped.
+    """
+    
+    RESYNC_DISTANCE = 1000  # Seq jumps this large mean the sender restarted
+    
+    def __init__(self, depth, max_wait=0.2):
+        self.depth = depth
+        self.max_wait = max_wait
+        self.pending = {}  # {seq: MediaPacket}
+        self.next_seq = None  # Next seq to play
+        self.newest_seq = None
+        self.gap_since = None  # When next_seq was first found missing
+    
+    def add(self, packet, now=None):
+        """Buffer a packet; returns the packets now due, in play order"""
+        seq = packet.seq
+        if self.next_seq is None or min((seq - self.next_seq) & 0xFFFF,
+                                         (self.next_seq - seq) & 0xFFFF) > self.RESYNC_DISTANCE:
+            self.pending = {}
+            self.next_seq = self.newest_seq = seq
+            self.gap_since = None
+        elif seq != self.next_seq and not seq_newer(seq, self.next_seq):
+            return []  # Its turn has passed
+        
+        self.pending[seq] = packet
+        if seq_newer(seq, self.newest_seq):
+            self.newest_seq = seq
+        return self._release(time.time() if now is None else now)
+    
+    def expire(self, now=None):
+        """Give up on a gap that has waited too long; returns the packets now due"""
+        return self._release(time.time() if now is None else now)
+    
+    def _release(self, now):
+        due = []
+        while self.pending:
+            packet = self.pending.pop(self.next_seq, None)
+            if packet is not None:
+                due.append(packet)
+                self.gap_since = None
+            else:
+                if self.gap_since is None:
+                    self.gap_since = now
+                behind = (self.newest_seq - self.next_seq) & 0xFFFF
+                if behind < self.depth and now - self.gap_since < self.max_wait:
+                    break  # Parity may still rebuild it
+            self.next_seq = (self.next_seq + 1) & 0xFFFF
+        return due
+
+
+class FrameAssembler:
+    """Reassembles fragmented video frames of one (sender, layer) stream.
+
+    Only fragments of frames that have partly arrived are NACKed: the relay
+    thins whole frames, so a frame with no fragments at all was most likely
+    skipped on purpose. Once a frame completes, older incomplete frames are
+    abandoned since the newer picture replaces them anyway.
+    """
+    
+    NACK_DELAY = 0.01     # Quiet time before a partial frame is NACKed (allows reordering)
+    NACK_RETRY = 0.04     # Re-NACK fragments still missing after this long
+    NACK_DEADLINE = 0.15  # Give up on a frame this long after its first fragment
+    MAX_PENDING = 4
+    
+    def __init__(self):
+        self.pending = {}  # {timestamp: _PartialFrame}
+        self.last_complete = None
+    
+    def add(self, packet, now):
+        """Store a fragment; returns the frame payload once it is complete"""
+        timestamp = packet.timestamp
+        if self.last_complete is not None and not timestamp_newer(timestamp, self.last_complete):
+            return None
+        if packet.frag_count <= 1:
+            self._complete(timestamp)
+            return packet.payload
+        
+        frame = self.pending.get(timestamp)
+        if frame is None:
+            if len(self.pending) >= self.MAX_PENDING:
+                del self.pending[next(iter(self.pending))]
+            frame = self.pending[timestamp] = _PartialFrame(packet, now)
+        if not frame.add(packet, now):
+            return None
+        self._complete(timestamp)
+        return b''.join(frame.parts)
+    
+    def missing(self, now):
+        """Return seqs of fragments that should be NACKed now"""
+        seqs = []
+        for timestamp, frame in list(self.pending.items()):
+            if now - frame.started > self.NACK_DEADLINE:
+                del self.pending[timestamp]
+                continue
+            since = frame.last_nack if frame.last_nack is not None else frame.last_arrival
+            wait = self.NACK_RETRY if frame.last_nack is not None else self.NACK_DELAY
+            if now - since < wait:
+                continue
+            frame.last_nack = now
+            seqs.extend((frame.first_seq + index) & 0xFFFF
+                        for index, part in enumerate(frame.parts) if part is None)
+        return seqs
+    
+    def _complete(self, timestamp):
+        self.last_complete = timestamp
+        for pending in list(self.pending):
+            if not timestamp_newer(pending, timestamp):
+                del self.pending[pending]
+
+
+class _PartialFrame:
+    """Fragments received so far for one video frame"""
+    
+    def __init__(self, packet, now):
+        self.first_seq = (packet.seq - packet.frag_index) & 0xFFFF
+        self.parts = [None] * packet.frag_count
+        self.remaining = packet.frag_count
+        self.started = now
+        self.last_arrival = now
+        self.last_nack = None
+    
+    def add(self, packet, now):
+        """Store a fragment; True once every fragment is present"""
+        index = packet.frag_index
+        if index < len(self.parts) and self.parts[index] is None:
+            self.parts[index] = packet.payload
+            self.remaining -= 1
+            self.last_arrival = now
+        return self.remaining == 0
+
+
+class FrameReader:
+    """Reads length-prefixed frames from a socket into one reusable buffer.
+
+    recv_into fills the buffer with as much as the kernel has, often several
+    small messages at once, and frames are handed out as memoryviews of it,
+    so large screen frames are neither concatenated nor copied on the way
+    in. A frame is only valid until the next read_frame call. Once the
+    connection has agreed to zlib (compressed set), compressed frames are
+    returned decompressed (as bytes). The buffer only grows as data arrives,
+    and a prefix over MAX_FRAME, a compressed frame that was not agreed or
+    one inflating past MAX_FRAME reads as end of stream.
+    """
+
+    # Buffers grown past this for a file transfer are given back afterwards;
+    # smaller ones (screen frames) are kept for the next frame
+    MAX_KEPT = 1 << 20
+
+    def __init__(self, sock, size=65536):
+        self.sock = sock
+        self.size = size
+        self.buffer = bytearray(size)
+        self.view = memoryview(self.buffer)
+        self.start = 0  # First unread byte
+        self.end = 0  # End of received data
+        self.compressed = False  # Accept zlib frames (set once negotiated)
+
+    def read_frame(self, idle_timeout=None):
+        """Payload of the next frame, or None at EOF or after idle_timeout
+        seconds without data (None waits through socket timeouts forever)"""
+        if self.start == self.end and len(self.buffer) > self.MAX_KEPT:
+            self.buffer = bytearray(self.size)
+            self.view = memoryview(self.buffer)
+            self.start = self.end = 0
+        if not self._fill(4, idle_timeout):
+            return None
+        prefix = struct.unpack_from('>I', self.buffer, self.start)[0]
+        length = prefix & ~COMPRESSED_FLAG
+        if length > MAX_FRAME:
+            return None
+        if not self._fill(4 + length, idle_timeout):
+            return None
+        frame = self.view[self.start + 4:self.start + 4 + length]
+        self.start += 4 + length
+        if self.start == self.end:
+            self.start = self.end = 0
+        if prefix & COMPRESSED_FLAG:
+            if not self.compressed:
+                return None
+            inflater = zlib.decompressobj()
+            try:
+                data = inflater.decompress(frame, MAX_FRAME)
+            except zlib.error:
+                return None
+            if inflater.unconsumed_tail:
+                return None  # Would inflate past MAX_FRAME
+            return data
+        return frame
+
+    def _fill(self, n, idle_timeout):
+        """Make n unread bytes available; False at EOF or idle timeout"""
+        if self.start + n > len(self.buffer) and self.start:
+            # Move the unread tail (at most one partial frame) to the front
+            pending = self.view[self.start:self.end].tobytes()
+            self.buffer[:len(pending)] = pending
+            self.start, self.end = 0, len(pending)
+
+        last_data = time.time()
+        while self.end - self.start < n:
+            if self.end == len(self.buffer):
+                # Grow only once the bytes are actually arriving, so a length
+                # prefix alone never commits memory
+                buffer = bytearray(min(2 * len(self.buffer), self.start + n))
+                buffer[:self.end] = self.view[:self.end]
+                self.buffer, self.view = buffer, memoryview(buffer)
+            try:
+                received = self.sock.recv_into(self.view[self.end:])
+            except socket.timeout:
+                # Socket timeouts only bound sends; a quiet link is dropped
+                # once it has missed several heartbeats
+                if idle_timeout is not None and time.time() - last_data >= idle_timeout:
+                    return False
+                continue
+            if not received:
+                return False
+            self.end += received
+            last_data = time.time()
+        return True
+
+
+class LatestSlot:
+    """Single-entry mailbox: a new value overwrites any value not yet taken.
+
+    Used wherever a consumer only cares about the most recent item (screen
+    frames, video frames), so a slow consumer skips straight to the newest
+    value instead of working through a backlog. Memory stays bounded at one
+    item per slot.
+    """
+
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._value = None
+        self._closed = False
+        self.dropped = 0  # Values overwritten before they were taken
+
+    def put(self, value):
+        """Store value, replacing any pending one"""
+        with self._cond:
+            if self._closed:
+                return
+            if self._value is not None:
+                self.dropped += 1
+            self._value = value
+            self._cond.notify()
+
+    def take(self, timeout=None):
+        """Wait for and remove the pending value (None on timeout or close)"""
+        with self._cond:
+            if self._value is None and not self._closed:
+                self._cond.wait(timeout)
+            value, self._value = self._value, None
+            return value
+
+    def close(self):
+        """Wake up any waiting consumer and reject further values"""
+        with self._cond:
+            self._closed = True
+            self._value = None
+            self._cond.notify_all()
+
+    @property
+    def closed(self):
+        return self._closed
@@ -6,35 +6,230 @@ Handles video, audio, screen sharing, chat, and file transfer
 
 import socket
 import threading
-import struct
-import json
 import time
 import os
+import secrets
+import multiprocessing
+from multiprocessing.reduction import send_handle, recv_handle
+from collections import deque
 from datetime import datetime
 
+from common import (LatestSlot, FrameReader, CompressionStats, encode_message, decode_message,
+                    send_all, pack_media_packet, parse_media_packet, parse_nack, set_dscp, select_layer,
+                    STREAM_VIDEO, STREAM_AUDIO, STREAM_NACK, STREAM_PROBE, DEFAULT_VIDEO_LAYER,
+                    LAYER_TIMEOUT, FEC_FLAG, TOS_AUDIO, TOS_VIDEO, LEVEL_SILENCE,
+                    HEARTBEAT_INTERVAL, HEARTBEAT_TIMEOUT, SEND_TIMEOUT)
+
+# Cached video frames older than this belong to stopped cameras
+KEYFRAME_MAX_AGE = 2.0
+
+# Frame-rate thinning tolerates this much arrival jitter (seconds)
+FPS_SLACK = 0.005
+
+# Video fragments kept per (sender, layer) for NACK retransmission
+RETRANSMIT_HISTORY = 512
+
+# Active-speaker detection from the audio level byte (-dBov)
+SPEECH_LEVEL = 50  # Quieter than -50 dBov counts as silence
+LEVEL_SMOOTHING = 0.3  # Weight of each packet in a sender's smoothed loudness
+SPEAKER_UPDATE_INTERVAL = 0.5
+SPEAKER_HOLD = 3  # dB head start for current speakers, avoids flapping
+SPEAKER_TIMEOUT = 1.0  # Senders without audio this long are not speaking
+
+# Relay queue bounds (packets); the oldest packets are dropped beyond these
+AUDIO_QUEUE_LIMIT = 256
+VIDEO_QUEUE_LIMIT = 1024
+
+# Ingress budgets per sender and stream type in KB/s (parity included, 0 =
+# unlimited); packets over budget are dropped before they are queued
+STREAM_NAMES = {STREAM_VIDEO: 'video', STREAM_AUDIO: 'audio', STREAM_NACK: 'nack'}
+RATE_LIMITS = {STREAM_VIDEO: 6000, STREAM_AUDIO: 64, STREAM_NACK: 32}
+RATE_BURST = 0.25  # Seconds of budget a sender may spend at once
+
+# Everything else arriving on the media port is dropped unread
+RELAYED_TYPES = set(STREAM_NAMES) | {STREAM_VIDEO | FEC_FLAG, STREAM_AUDIO | FEC_FLAG}
+
+
+class RelayQueue:
+    """Two-class packet queue for the UDP relay: audio is always served first.
+
+    A burst of video fragments (someone turning on a camera) can no longer
+    hold up voice packets behind it. Both queues are bounded and drop their
+    oldest packets when the forwarder falls behind.
+    """
+    
+    def __init__(self, audio_limit=AUDIO_QUEUE_LIMIT, video_limit=VIDEO_QUEUE_LIMIT):
+        self._cond = threading.Condition()
+        self._audio = deque(maxlen=audio_limit)
+        self._video = deque(maxlen=video_limit)
+        self._closed = False
+        self.dropped = {STREAM_AUDIO: 0, STREAM_VIDEO: 0}
+    
+    def put(self, item, is_audio):
+        """Queue item in the audio or the video class"""
+        queue = self._audio if is_audio else self._video
+        with self._cond:
+            if self._closed:
+                return
+            if len(queue) == queue.maxlen:
+                self.dropped[STREAM_AUDIO if is_audio else STREAM_VIDEO] += 1
+            queue.append(item)
+            self._cond.notify()
+    
+    def get(self, timeout=None):
+        """Wait for the next item, audio first (None on timeout or close)"""
+        with self._cond:
+            if not self._audio and not self._video and not self._closed:
+                self._cond.wait(timeout)
+            if self._audio:
+                return self._audio.popleft()
+            if self._video:
+                return self._video.popleft()
+            return None
+    
+    def close(self):
+        """Wake up the forwarder and reject further items"""
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+
+
+class TokenBucket:
+    """Refills at rate bytes/s up to burst bytes; a packet passes if it can pay its size"""
+    
+    __slots__ = ('rate', 'burst', 'tokens', 'last')
+    
+    def __init__(self, rate, burst, now):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.last = now
+    
+    def take(self, amount, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+        self.last = now
+        if self.tokens < amount:
+            return False
+        self.tokens -= amount
+        return True
+
+
+# Room used when a client does not ask for one
+DEFAULT_ROOM = 'main'
+
+# Seconds between attempts to (re)connect to a configured peer server
+PEER_RETRY_INTERVAL = 5.0
+
+# Joins and leaves within this many seconds go out as one presence delta
+PRESENCE_COALESCE = 0.1
+
+# Multicast mode: room groups are MULTICAST_PREFIX + 1..254 (organization-local scope)
+MULTICAST_PREFIX = '239.255.77.'
+
+
+def valid_register(msg):
+    """True if a register message has the fields handle_client relies on"""
+    username = msg.get('username')
+    udp_port = msg.get('udp_port')
+    return (isinstance(username, str) and 0 < len(username.encode('utf-8')) <= 255
+            and isinstance(udp_port, int) and 0 < udp_port < 65536)
+
+
+class Room:
+    """One independent meeting: its members and everything they share.
+
+    Broadcasts and the media relay only walk a room's own members, so the
+    cost of a message grows with the room, not with the whole server.
+    """
+    
+    def __init__(self, name):
+        self.name = name
+        self.members = {}  # {username: client info, the same dict as LANServer.clients[username]}
+        self.remote_members = {}  # {username: peer server name} for users on peered servers
+        self.multicast_group = None  # (group, port) in multicast mode
+        
+        # Session state
+        self.presenter = None
+        self.chat_history = []
+        self.files = {}  # {filename: file_data}
+        
+        # Presence deltas: clients hold the user list at presence_version and
+        # apply each numbered delta; changes wait here for the next one
+        self.presence_version = 0
+        self.presence_joined = []
+        self.presence_left = []
+        self.presence_flush_pending = False
+        
+        # Late-joiner cache: newest complete frames so new clients see
+        # content immediately instead of waiting for the next one
+        self.last_screen_frame = None  # Encoded screen_frame from the presenter
+        self.video_keyframes = {}  # {username: {layer: (received_at, [fragments of newest complete frame])}}
+        self.video_frame_parts = {}  # {(username, layer): (timestamp, [fragments so far])}
+        
+        # Recently relayed video fragments, resent when a receiver NACKs them
+        self.packet_cache = {}  # {(username, layer): {seq: datagram}}
+        
+        # Active speakers: only their audio and high video layers are relayed
+        self.audio_levels = {}  # {username: [smoothed loudness above silence (dB), last packet time]}
+        self.active_speakers = []
+        self.last_speaker_update = 0
+        self.speakers_announce_pending = False  # An announcer thread will send the current set
+
+
 class LANServer:
-    def __init__(self, host='0.0.0.0', tcp_port=5555, udp_port=5556):
+    def __init__(self, host='0.0.0.0', tcp_port=5555, udp_port=5556, screen_port=5557,
+                 max_active_speakers=3, peers=(), multicast_port=None, rate_limits=None):
         self.host = host
         self.tcp_port = tcp_port
         self.udp_port = udp_port
+        self.screen_port = screen_port
+        self.max_active_speakers = max_active_speakers  # 0 forwards everyone
         
-        # Client management
-        self.clients = {}  # {username: {'tcp': socket, 'address': (ip, port), 'udp_port': port}}
+        # Client management: usernames are unique server-wide because media
+        # packets identify their sender by username only
+        self.clients = {}  # {username: {'tcp': socket, 'address': (ip, port), 'udp_port': port, 'room': Room, 'screen': socket, 'screen_slot': LatestSlot}}
         self.clients_lock = threading.Lock()
+        self.speakers_lock = threading.Lock()  # Keeps speaker announcements in order
+        self.rooms = {}  # {name: Room}, created on first join, dropped when empty
         
-        # Session state
-        self.presenter = None
-        self.chat_history = []
-        self.files = {}  # {filename: file_data}
+        # Multicast mode: each room's media is sent once to its group for
+        # members that confirmed they receive it, unicast to everyone else
+        self.multicast_port = multicast_port
+        self.next_multicast_group = 0
+        
+        # Cascading: linked servers exchange each local stream once per peer,
+        # plus chat and presence; rooms with the same name are one meeting
+        self.name = f"{socket.gethostname()}:{tcp_port}"
+        self.peer_addresses = list(peers)  # [(host, tcp_port)] to connect to
+        self.peers = {}  # {name: {'tcp': socket, 'udp_addr': (ip, port), 'media_addrs': {(ip, port)}}}
+        self.remote_users = {}  # {username: {'peer': name, 'room': room name}}
+        
+        # Received media waiting for the relay thread
+        self.relay_queue = RelayQueue()
+        
+        # Ingress rate limiting, only touched by the UDP receive thread
+        self.rate_limits = dict(RATE_LIMITS if rate_limits is None else rate_limits)  # {stream_type: KB/s}
+        self.rate_buckets = {}  # {username: {stream_type: TokenBucket}}
+        self.rate_dropped = {}  # {username: {stream name: packets dropped}}
+        
+        # Control messages to clients that negotiated zlib at register
+        self.compression_stats = CompressionStats()
+        
+        # Worker mode: the Supervisor hands clients over this pipe and learns
+        # from it when a room empties, so the room can move to another worker
+        self.handoff_conn = None
+        self.room_handoffs = {}  # {room name: handed-off clients settled since the last room_closed}
         
         # Sockets
         self.tcp_socket = None
         self.udp_socket = None
+        self.udp_audio_socket = None  # Sends audio with its own DSCP marking
+        self.screen_socket = None
         
         # Running flag
         self.running = False
         
-        print(f"[SERVER] Initializing server on {host}:{tcp_port} (TCP) and {udp_port} (UDP)")
+        print(f"[SERVER] Initializing server on {host}:{tcp_port} (TCP), {udp_port} (UDP) and {screen_port} (screen)")
     
     def start(self):
         """Start the server"""
@@ -45,17 +240,11 @@ class LANServer:
         self.tcp_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
         self.tcp_socket.bind((self.host, self.tcp_port))
         self.tcp_socket.listen(10)
-        
-        # Setup UDP socket for video and audio streaming
-        self.udp_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        self.udp_socket.bind((self.host, self.udp_port))
-        
         print(f"[SERVER] TCP listening on {self.host}:{self.tcp_port}")
-        print(f"[SERVER] UDP listening on {self.host}:{self.udp_port}")
         
-        # Start UDP handler thread
-        udp_thread = threading.Thread(target=self.handle_udp_streams, daemon=True)
-        udp_thread.start()
+        self.start_media()
+        for peer_host, peer_port in self.peer_addresses:
+            threading.Thread(target=self.connect_peer, args=(peer_host, peer_port), daemon=True).start()
         
         # Accept TCP connections
         try:
@@ -72,57 +261,188 @@ class LANServer:
         finally:
             self.shutdown()
     
-    def handle_client(self, client_sock, addr):
-        """Handle individual client TCP connection"""
+    def serve_handoffs(self, conn):
+        """Worker mode: serve clients whose connections the Supervisor passes over conn"""
+        self.running = True
+        self.handoff_conn = conn
+        self.start_media()
+        try:
+            while self.running:
+                try:
+                    register, addr = conn.recv()
+                    client_sock = socket.socket(fileno=recv_handle(conn))
+                except (EOFError, OSError):
+                    break
+                threading.Thread(target=self.handle_client, args=(client_sock, addr, register), daemon=True).start()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.shutdown()
+    
+    def start_media(self):
+        """Open the UDP and screen channel sockets and start their threads"""
+        # Setup UDP socket for video and audio streaming; relayed audio goes
+        # out of a second socket so each class carries its own DSCP marking
+        self.udp_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.udp_socket.bind((self.host, self.udp_port))
+        set_dscp(self.udp_socket, TOS_VIDEO)
+        self.udp_audio_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.udp_audio_socket.bind((self.host, 0))  # Fixed source port, announced to peers
+        set_dscp(self.udp_audio_socket, TOS_AUDIO)
+        if self.multicast_port:
+            # Keep group traffic on the local network, leaving by the listening interface
+            for sock in (self.udp_socket, self.udp_audio_socket):
+                sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, 1)
+                if self.host not in ('', '0.0.0.0'):
+                    sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_IF, socket.inet_aton(self.host))
+        
+        # Setup dedicated TCP socket for screen sharing, so large frames
+        # never sit in front of chat and control messages
+        self.screen_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.screen_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.screen_socket.bind((self.host, self.screen_port))
+        self.screen_socket.listen(10)
+        
+        print(f"[SERVER] UDP listening on {self.host}:{self.udp_port}")
+        print(f"[SERVER] Screen channel listening on {self.host}:{self.screen_port}")
+        
+        # Start UDP receive and relay threads
+        udp_thread = threading.Thread(target=self.handle_udp_streams, daemon=True)
+        udp_thread.start()
+        relay_thread = threading.Thread(target=self.relay_udp_streams, daemon=True)
+        relay_thread.start()
+        
+        # Start screen channel acceptor thread
+        screen_thread = threading.Thread(target=self.accept_screen_connections, daemon=True)
+        screen_thread.start()
+        
+        # Start heartbeat thread
+        heartbeat_thread = threading.Thread(target=self.send_heartbeats, daemon=True)
+        heartbeat_thread.start()
+    
+    def handle_client(self, client_sock, addr, register=None):
+        """Handle individual client TCP connection (register is already read in worker mode)"""
         username = None
+        handoff_room = None  # Worker mode: room of a handoff not yet reported as settled
+        # Bounds every send to this client; silence is detected by the reader
+        client_sock.settimeout(SEND_TIMEOUT)
+        reader = FrameReader(client_sock)
         try:
             # Receive initial registration
-            data = self.recv_message(client_sock)
+            data = register or self.recv_message(reader)
+            if data and data['type'] == 'peer_hello':
+                # Another server linking to us rather than a client
+                self.handle_peer(reader, data, reply=True)
+                return
             if data and data['type'] == 'register':
+                room_name = str(data.get('room') or DEFAULT_ROOM)
+                if register:
+                    handoff_room = room_name
+                if not valid_register(data):
+                    raise ValueError("malformed register")
                 username = data['username']
                 udp_port = data['udp_port']
+                screen_token = secrets.token_hex(8)
                 
                 with self.clients_lock:
-                    self.clients[username] = {
+                    if username in self.clients or username in self.remote_users:
+                        # Taking over the entry would strand the first connection in its
+                        # room, and a peer's user of the same name would make the two
+                        # servers' streams indistinguishable; the finally must leave
+                        # that connection alone too
+                        taken, username = username, None
+                        self.settle_handoff(handoff_room)
+                        handoff_room = None
+                        print(f"[SERVER] Rejected {addr}: username '{taken}' is already taken")
+                        try:
+                            self.send_message(client_sock, {
+                                'type': 'register_rejected',
+                                'reason': f"Username '{taken}' is already taken"
+                            })
+                        finally:
+                            client_sock.close()
+                        return
+                    
+                    room = self.get_room(room_name)
+                    self.settle_handoff(handoff_room)
+                    handoff_room = None
+                    info = self.clients[username] = room.members[username] = {
                         'tcp': client_sock,
                         'address': addr,
-                        'udp_port': udp_port
+                        'udp_port': udp_port,
+                        'room': room,
+                        'screen': None,
+                        'screen_slot': None,
+                        'screen_token': screen_token,
+                        'video_layers': {},  # {sender: requested simulcast layer}
+                        'max_fps': {},  # {sender or None (all senders): max video fps}
+                        'last_video_sent': {},  # {sender: (time, timestamp) of last forwarded frame}
+                        'multicast': False,  # Confirmed receiving the room's multicast group
+                        'multicast_token': None,
+                        'compress': 'zlib' in (data.get('compression') or ()),
+                        'forwarded': {}  # {sender: video packets forwarded since last receiver report}
                     }
+                    reader.compressed = info['compress']
+                    
+                    # Send current state (chat history makes this the biggest control
+                    # message); under the lock, so no broadcast can overtake it and
+                    # the users snapshot matches presence_version
+                    self.send_message(client_sock, {
+                        'type': 'registered',
+                        'room': room_name,
+                        'users': self.room_users(room),
+                        'presence_version': room.presence_version,
+                        'chat_history': room.chat_history,
+                        'presenter': room.presenter,
+                        'active_speakers': room.active_speakers,
+                        'udp_port': self.udp_port,
+                        'screen_port': self.screen_port,
+                        'screen_token': screen_token,
+                        'multicast': room.multicast_group and {
+                            'group': room.multicast_group[0],
+                            'port': room.multicast_group[1]
+                        },
+                        'compression': 'zlib' if info['compress'] else None
+                    }, compress=info['compress'])
                 
-                print(f"[SERVER] {username} registered from {addr}")
+                print(f"[SERVER] {username} registered from {addr} in room '{room_name}'")
                 
-                # Send current state
-                self.send_message(client_sock, {
-                    'type': 'registered',
-                    'users': list(self.clients.keys()),
-                    'chat_history': self.chat_history,
-                    'presenter': self.presenter
-                })
+                # Fast start: latest frame of every active video stream
+                self.send_video_keyframes(username)
                 
                 # Notify others
-                self.broadcast_tcp({
-                    'type': 'user_joined',
-                    'username': username,
-                    'users': list(self.clients.keys())
-                }, exclude=username)
+                self.queue_presence(room, username, joined=True)
+                self.send_to_peers({
+                    'type': 'peer_join',
+                    'room': room_name,
+                    'username': username
+                })
                 
                 # Handle messages from this client
                 while self.running:
-                    msg = self.recv_message(client_sock)
+                    msg = self.recv_message(reader)
                     if not msg:
                         break
                     
                     self.process_message(username, msg)
             
+            if username and self.running:
+                print(f"[SERVER] Lost connection to {username}")
+            
         except Exception as e:
             print(f"[SERVER] Error with {username or addr}: {e}")
         finally:
+            if handoff_room is not None:
+                with self.clients_lock:
+                    self.settle_handoff(handoff_room)
+                client_sock.close()
             if username:
                 self.disconnect_client(username)
     
     def process_message(self, username, msg):
         """Process different message types"""
         msg_type = msg.get('type')
+        room = self.clients[username]['room']
         
         if msg_type == 'chat':
             # Broadcast chat message
@@ -132,14 +452,19 @@ class LANServer:
                 'message': msg['message'],
                 'timestamp': datetime.now().strftime('%H:%M:%S')
             }
-            self.chat_history.append(chat_msg)
-            self.broadcast_tcp(chat_msg)
+            room.chat_history.append(chat_msg)
+            self.broadcast_tcp(room, chat_msg)
+            self.send_to_peers({
+                'type': 'peer_chat',
+                'room': room.name,
+                'chat': chat_msg
+            })
             
         elif msg_type == 'start_presenting':
             # Set presenter
-            if self.presenter is None:
-                self.presenter = username
-                self.broadcast_tcp({
+            if room.presenter is None:
+                room.presenter = username
+                self.broadcast_tcp(room, {
                     'type': 'presenter_changed',
                     'presenter': username
                 })
@@ -147,22 +472,51 @@ class LANServer:
             
         elif msg_type == 'stop_presenting':
             # Stop presenting
-            if self.presenter == username:
-                self.presenter = None
-                self.broadcast_tcp({
+            if room.presenter == username:
+                room.presenter = None
+                room.last_screen_frame = None
+                self.broadcast_tcp(room, {
                     'type': 'presenter_changed',
                     'presenter': None
                 })
                 print(f"[SERVER] {username} stopped presenting")
         
-        elif msg_type == 'screen_frame':
-            # Broadcast screen frame to all except sender
-            frame_msg = {
-                'type': 'screen_frame',
-                'presenter': username,
-                'frame': msg['frame']
-            }
-            self.broadcast_tcp(frame_msg, exclude=username)
+        elif msg_type == 'video_layer':
+            # Receiver picks which simulcast layer it wants from a sender
+            with self.clients_lock:
+                if username in self.clients:
+                    self.clients[username]['video_layers'][msg['sender']] = int(msg['layer'])
+        
+        elif msg_type == 'max_fps':
+            # Receiver caps the video frame rate it wants, per sender or for all
+            fps = msg.get('fps')
+            with self.clients_lock:
+                if username in self.clients:
+                    limits = self.clients[username]['max_fps']
+                    if fps:
+                        limits[msg.get('sender')] = float(fps)
+                    else:
+                        limits.pop(msg.get('sender'), None)
+        
+        elif msg_type == 'receiver_report':
+            self.relay_receiver_report(username, msg)
+        
+        elif msg_type == 'multicast_probe':
+            # Client joined the group: prove it with a packet sent to the group
+            if room.multicast_group:
+                token = secrets.token_hex(4)
+                with self.clients_lock:
+                    self.clients[username]['multicast_token'] = token
+                self.udp_socket.sendto(pack_media_packet(STREAM_PROBE, username, token.encode()),
+                                       room.multicast_group)
+        
+        elif msg_type == 'multicast_ok':
+            # The probe arrived, so group traffic replaces unicast for this client
+            with self.clients_lock:
+                info = self.clients[username]
+                if info['multicast_token'] and msg.get('token') == info['multicast_token']:
+                    info['multicast'] = True
+                    print(f"[SERVER] {username} receives room '{room.name}' by multicast")
         
         elif msg_type == 'file_upload':
             # Handle file upload
@@ -170,10 +524,10 @@ class LANServer:
             filesize = msg['filesize']
             filedata = msg['filedata']
             
-            self.files[filename] = filedata
+            room.files[filename] = filedata
             
             # Notify all clients about new file
-            self.broadcast_tcp({
+            self.broadcast_tcp(room, {
                 'type': 'file_available',
                 'username': username,
                 'filename': filename,
@@ -185,117 +539,803 @@ class LANServer:
         elif msg_type == 'file_download':
             # Send file to requesting client
             filename = msg['filename']
-            if filename in self.files:
+            if filename in room.files:
+                info = self.clients[username]
+                # Compress before taking the lock that every sender needs
+                data = encode_message({
+                    'type': 'file_data',
+                    'filename': filename,
+                    'filedata': room.files[filename]
+                }, info['compress'], self.compression_stats)
                 with self.clients_lock:
                     if username in self.clients:
-                        self.send_message(self.clients[username]['tcp'], {
-                            'type': 'file_data',
-                            'filename': filename,
-                            'filedata': self.files[filename]
-                        })
+                        send_all(info['tcp'], data)
+        
+        elif msg_type == 'presence_resync':
+            # Client missed a delta: full user list at the current version
+            with self.clients_lock:
+                self.send_message(self.clients[username]['tcp'], {
+                    'type': 'presence_snapshot',
+                    'users': self.room_users(room),
+                    'version': room.presence_version
+                }, compress=self.clients[username]['compress'])
+        
+        elif msg_type == 'stats':
+            # Server counters for monitoring tools
+            with self.clients_lock:
+                self.send_message(self.clients[username]['tcp'], {
+                    'type': 'stats',
+                    'compression': self.compression_stats.snapshot(),
+                    'relay_dropped': {
+                        'audio': self.relay_queue.dropped[STREAM_AUDIO],
+                        'video': self.relay_queue.dropped[STREAM_VIDEO]
+                    },
+                    'rate_limited': {user: dict(dropped) for user, dropped in list(self.rate_dropped.items())}
+                }, compress=self.clients[username]['compress'])
+    
+    def accept_screen_connections(self):
+        """Accept screen channel connections"""
+        while self.running:
+            try:
+                self.screen_socket.settimeout(1.0)
+                screen_sock, addr = self.screen_socket.accept()
+                threading.Thread(target=self.handle_screen_client, args=(screen_sock, addr), daemon=True).start()
+            except socket.timeout:
+                continue
+            except OSError:
+                break
+    
+    def handle_screen_client(self, screen_sock, addr):
+        """Handle a client's screen channel connection"""
+        # Big frames get the longer timeout; they are never sent under the lock
+        screen_sock.settimeout(HEARTBEAT_TIMEOUT)
+        reader = FrameReader(screen_sock)
+        username = None
+        slot = LatestSlot()
+        try:
+            # First message binds this connection to a registered user
+            hello = self.recv_message(reader)
+            if not hello or hello.get('type') != 'screen_hello':
+                screen_sock.close()
+                return
+            
+            with self.clients_lock:
+                info = self.clients.get(hello.get('username'))
+                if info and info['screen_token'] == hello.get('token'):
+                    username = hello['username']
+                    info['screen'] = screen_sock
+                    info['screen_slot'] = slot
+                    
+                    # Fast start: current slide before the presenter's next frame
+                    room = info['room']
+                    if room.last_screen_frame and room.presenter != username:
+                        slot.put(room.last_screen_frame)
+            
+            if not username:
+                print(f"[SERVER] Rejected screen channel from {addr}")
+                screen_sock.close()
+                return
+            
+            print(f"[SERVER] {username} opened screen channel")
+            
+            # One writer per receiver: it always sends the newest pending frame
+            threading.Thread(target=self.screen_sender, args=(username, screen_sock, slot), daemon=True).start()
+            
+            # Viewers never send on this channel; it lives as long as the
+            # control connection, which closes it in disconnect_client
+            while self.running:
+                msg = self.recv_message(reader, idle_timeout=None)
+                if not msg:
+                    break
+                
+                if msg.get('type') == 'screen_frame':
+                    # Broadcast screen frame to all except sender
+                    self.broadcast_screen(username, {
+                        'type': 'screen_frame',
+                        'presenter': username,
+                        'frame': msg['frame']
+                    })
+        
+        except Exception as e:
+            print(f"[SERVER] Screen channel error with {username or addr}: {e}")
+        finally:
+            slot.close()
+            with self.clients_lock:
+                info = self.clients.get(username)
+                if info and info['screen'] is screen_sock:
+                    info['screen'] = None
+                    info['screen_slot'] = None
+            try:
+                screen_sock.close()
+            except:
+                pass
+    
+    def screen_sender(self, username, screen_sock, slot):
+        """Send screen frames to one receiver, skipping frames it fell behind on"""
+        while self.running and not slot.closed:
+            data = slot.take(timeout=1.0)
+            if data is None:
+                continue
+            try:
+                send_all(screen_sock, data)
+            except Exception:
+                self.drop_connection(screen_sock)
+                break
+        
+        if slot.dropped:
+            print(f"[SERVER] Skipped {slot.dropped} stale screen frames for {username}")
     
     def handle_udp_streams(self):
-        """Handle UDP video and audio streams"""
+        """Receive UDP video and audio streams and queue them by priority"""
         print("[SERVER] UDP stream handler started")
         while self.running:
             try:
                 data, addr = self.udp_socket.recvfrom(65535)
                 
-                # Parse header: type (1 byte) + username length (1 byte) + username
-                if len(data) < 2:
+                # Parse header: type + username + layer
+                packet = parse_media_packet(data)
+                if packet is None or packet.stream_type not in RELAYED_TYPES:
                     continue
-                
-                stream_type = data[0]  # 1=video, 2=audio
-                username_len = data[1]
-                
-                if len(data) < 2 + username_len:
+                if not self.sent_by(packet, addr):
                     continue
                 
-                username = data[2:2+username_len].decode('utf-8')
-                payload = data[2+username_len:]
+                # A flooding sender loses its excess here, before it costs
+                # queue space or fan-out work
+                if not self.within_rate_limit(packet, len(data)):
+                    continue
                 
-                # Broadcast to all other clients
-                with self.clients_lock:
-                    for user, info in self.clients.items():
-                        if user != username:
-                            try:
-                                # Send to client's UDP port
-                                client_addr = (info['address'][0], info['udp_port'])
-                                self.udp_socket.sendto(data, client_addr)
-                            except Exception as e:
-                                pass
+                # Audio (and its parity) jumps ahead of video and NACKs
+                is_audio = packet.stream_type & ~FEC_FLAG == STREAM_AUDIO
+                self.relay_queue.put((packet, data, addr), is_audio)
                                 
             except Exception as e:
                 if self.running:
                     print(f"[SERVER] UDP error: {e}")
     
-    def broadcast_tcp(self, message, exclude=None):
-        """Broadcast TCP message to all clients"""
+    def sent_by(self, packet, addr):
+        """True if a datagram comes from where its username is connected: the
+        client's own host, or the media socket of the peer serving that user.
+        Anyone else could spend (and exhaust) that user's rate budget."""
+        peer_name = self.peer_for_addr(addr)
+        if peer_name is not None:
+            remote = self.remote_users.get(packet.username)
+            return remote is not None and remote['peer'] == peer_name
+        info = self.clients.get(packet.username)
+        return info is not None and info['address'][0] == addr[0]
+    
+    def within_rate_limit(self, packet, size):
+        """Charge a packet to its sender's token bucket for its stream type"""
+        stream_type = packet.stream_type & ~FEC_FLAG
+        rate = self.rate_limits.get(stream_type)
+        if not rate:
+            return True
+        buckets = self.rate_buckets.get(packet.username)
+        if buckets is None:
+            buckets = self.rate_buckets[packet.username] = {}
+        now = time.time()
+        bucket = buckets.get(stream_type)
+        if bucket is None:
+            bucket = buckets[stream_type] = TokenBucket(rate * 1024, rate * 1024 * RATE_BURST, now)
+        if bucket.take(size, now):
+            return True
+        
+        dropped = self.rate_dropped.setdefault(packet.username, {})
+        name = STREAM_NAMES[stream_type]
+        if name not in dropped:
+            print(f"[SERVER] Rate limiting {packet.username}'s {name} ({rate} KB/s)")
+        dropped[name] = dropped.get(name, 0) + 1
+        return False
+    
+    def relay_udp_streams(self):
+        """Forward queued media packets, always draining audio first"""
+        while self.running:
+            item = self.relay_queue.get(timeout=1.0)
+            if item is None:
+                continue
+            try:
+                self.relay_media_packet(*item)
+            except Exception as e:
+                if self.running:
+                    print(f"[SERVER] UDP relay error: {e}")
+    
+    def relay_media_packet(self, packet, data, addr):
+        """Forward one media packet to every receiver that should get it"""
+        if packet.stream_type == STREAM_NACK:
+            self.retransmit_video(packet, addr)
+            return
+        
+        username = packet.username
+        peer_name = self.peer_for_addr(addr)
+        if peer_name is None:
+            sender_info = self.clients.get(username)
+            if sender_info is None:
+                return
+            room = sender_info['room']
+        else:
+            # Streams from peered servers are only relayed to local members,
+            # never on to other peers, so a full mesh cannot loop, even when
+            # both sides have a user of the same name
+            sender_info = None
+            remote = self.remote_users.get(username)
+            if remote is None or remote['peer'] != peer_name:
+                return
+            room = self.rooms.get(remote['room'])
+            if room is None:
+                return
+        is_parity = bool(packet.stream_type & FEC_FLAG)
+        is_video = packet.stream_type & ~FEC_FLAG == STREAM_VIDEO
+        send_socket = self.udp_socket if is_video else self.udp_audio_socket
+        now = time.time()
+        
+        if sender_info is not None and room.remote_members:
+            self.forward_to_peers(room, data, send_socket)
+        
+        if is_video and not is_parity:
+            self.cache_video_packet(room, username, packet, data, now)
+        
+        if self.max_active_speakers:
+            if not is_video and not is_parity:
+                self.update_audio_level(room, username, packet.level, now)
+            if now - room.last_speaker_update >= SPEAKER_UPDATE_INTERVAL:
+                self.update_active_speakers(room, now)
+            if not is_video and not self.audio_forwarded(room, username, packet):
+                return
+        
+        # Broadcast to the other members of the sender's room
+        multicast_needed = False
         with self.clients_lock:
-            for username, info in list(self.clients.items()):
-                if username != exclude:
+            for user, info in room.members.items():
+                if user != username:
+                    # Each receiver only gets the simulcast layer it asked for
+                    if is_video and packet.layer != self.select_video_layer(room, info, username, now):
+                        continue
+                    if is_parity:
+                        # Parity is useless once fps thinning removed most of its group
+                        if is_video and info['max_fps']:
+                            continue
+                    # ...and no faster than the frame rate it declared
+                    elif is_video and info['max_fps'] and not self.video_frame_due(info, username, now,
+                                                                                   packet.timestamp):
+                        continue
+                    elif is_video:
+                        info['forwarded'][username] = info['forwarded'].get(username, 0) + 1
+                    if info['multicast']:
+                        # Covered by the single group send below
+                        multicast_needed = True
+                        continue
                     try:
-                        self.send_message(info['tcp'], message)
-                    except:
+                        # Send to client's UDP port
+                        client_addr = (info['address'][0], info['udp_port'])
+                        send_socket.sendto(data, client_addr)
+                    except Exception as e:
                         pass
+            
+            if multicast_needed:
+                try:
+                    send_socket.sendto(data, room.multicast_group)
+                except Exception:
+                    pass
+    
+    def update_audio_level(self, room, username, level, now):
+        """Fold one audio packet's level into the sender's smoothed loudness"""
+        loudness = LEVEL_SILENCE - min(level, LEVEL_SILENCE)
+        state = room.audio_levels.get(username)
+        if state is None:
+            room.audio_levels[username] = [loudness, now]
+        else:
+            state[0] += (loudness - state[0]) * LEVEL_SMOOTHING
+            state[1] = now
+    
+    def update_active_speakers(self, room, now):
+        """Pick a room's loudest senders and announce the set when it changes"""
+        room.last_speaker_update = now
+        ranked = []
+        for username, (loudness, last_seen) in list(room.audio_levels.items()):
+            if now - last_seen > SPEAKER_TIMEOUT:
+                continue
+            if username in room.active_speakers:
+                loudness += SPEAKER_HOLD
+            if loudness > LEVEL_SILENCE - SPEECH_LEVEL:
+                ranked.append((loudness, username))
+        ranked.sort(reverse=True)
+        chosen = {username for _, username in ranked[:self.max_active_speakers]}
+        
+        # Keep the order of speakers who stay so client layouts are stable
+        speakers = [u for u in room.active_speakers if u in chosen]
+        speakers += [username for _, username in ranked if username in chosen and username not in speakers]
+        if speakers == room.active_speakers:
+            return
+        room.active_speakers = speakers
+        # The relay thread must not wait on a slow member's TCP send
+        if not room.speakers_announce_pending:
+            room.speakers_announce_pending = True
+            threading.Thread(target=self.announce_active_speakers, args=(room,), daemon=True).start()
+    
+    def announce_active_speakers(self, room):
+        """Broadcast a room's current speaker set (changes meanwhile are folded in)"""
+        with self.speakers_lock:
+            room.speakers_announce_pending = False
+            self.broadcast_tcp(room, {
+                'type': 'active_speakers',
+                'speakers': list(room.active_speakers)
+            })
+    
+    def audio_forwarded(self, room, username, packet):
+        """Whether a sender's audio packet is relayed: active speakers always,
+        others only while a speaker slot is free and they are talking, so a
+        new speaker is heard before the next re-ranking picks them up"""
+        if username in room.active_speakers:
+            return True
+        return (len(room.active_speakers) < self.max_active_speakers
+                and packet.level < SPEECH_LEVEL)
+    
+    def cache_video_packet(self, room, username, packet, data, now):
+        """Keep a video fragment for retransmission and reassemble keyframes.
+
+        The newest complete frame per layer is what late joiners receive;
+        it also tracks which layers are being published.
+        """
+        key = (username, packet.layer)
+        history = room.packet_cache.setdefault(key, {})
+        history[packet.seq] = data
+        if len(history) > RETRANSMIT_HISTORY:
+            # Drop the oldest half; dicts keep insertion order
+            for seq in list(history)[:RETRANSMIT_HISTORY // 2]:
+                del history[seq]
+        
+        timestamp, parts = room.video_frame_parts.get(key, (None, None))
+        if timestamp != packet.timestamp:
+            parts = [None] * packet.frag_count
+            room.video_frame_parts[key] = (packet.timestamp, parts)
+        if packet.frag_index < len(parts):
+            parts[packet.frag_index] = data
+        if None not in parts:
+            room.video_keyframes.setdefault(username, {})[packet.layer] = (now, parts)
+    
+    def retransmit_video(self, nack, addr):
+        """Resend the cached video fragments a receiver NACKed"""
+        parsed = parse_nack(nack.payload)
+        if parsed is None:
+            return
+        sender, seqs = parsed
+        
+        with self.clients_lock:
+            info = self.clients.get(nack.username)
+            if not info or info['address'][0] != addr[0]:
+                return
+            if sender not in info['room'].members and sender not in info['room'].remote_members:
+                return
+            history = info['room'].packet_cache.get((sender, nack.layer), {})
+            client_addr = (info['address'][0], info['udp_port'])
+            resent = 0
+            for seq in seqs:
+                data = history.get(seq)
+                if data is None:
+                    continue
+                try:
+                    self.udp_socket.sendto(data, client_addr)
+                    resent += 1
+                except Exception:
+                    pass
+            # Counted like any forwarded packet so receiver reports stay balanced
+            info['forwarded'][sender] = info['forwarded'].get(sender, 0) + resent
+    
+    def broadcast_tcp(self, room, message, exclude=None):
+        """Broadcast TCP message to all members of a room"""
+        # Serialize once per encoding and share the buffer between recipients
+        encoded = {}  # {compress: frame}
+        with self.clients_lock:
+            for username, info in list(room.members.items()):
+                if username != exclude:
+                    data = encoded.get(info['compress'])
+                    if data is None:
+                        data = encoded[info['compress']] = encode_message(message, info['compress'],
+                                                                          self.compression_stats)
+                    try:
+                        send_all(info['tcp'], data)
+                    except OSError:
+                        # Its handler sees the closed socket and disconnects it
+                        self.drop_connection(info['tcp'])
+    
+    def broadcast_screen(self, sender, message):
+        """Queue screen message for every receiver, replacing any frame still pending"""
+        data = encode_message(message)
+        with self.clients_lock:
+            sender_info = self.clients.get(sender)
+            if not sender_info:
+                return
+            room = sender_info['room']
+            if sender == room.presenter:
+                room.last_screen_frame = data
+            for username, info in room.members.items():
+                if username != sender and info['screen_slot']:
+                    info['screen_slot'].put(data)
+    
+    def send_video_keyframes(self, username):
+        """Send the cached latest frame of every other video stream to a client"""
+        with self.clients_lock:
+            info = self.clients.get(username)
+            if not info:
+                return
+            client_addr = (info['address'][0], info['udp_port'])
+            room = info['room']
+            now = time.time()
+            packets = []
+            for sender, layers in room.video_keyframes.items():
+                if sender == username:
+                    continue
+                layer = self.select_video_layer(room, info, sender, now)
+                received_at, parts = layers.get(layer, (0, None))
+                if parts and now - received_at < KEYFRAME_MAX_AGE:
+                    packets.extend(parts)
+        
+        for packet in packets:
+            try:
+                self.udp_socket.sendto(packet, client_addr)
+            except Exception:
+                pass
+    
+    def relay_receiver_report(self, receiver, msg):
+        """Turn a receiver's report into per-sender feedback and deliver it.
+
+        Loss is measured against what the relay actually forwarded to this
+        receiver, so layer selection and fps thinning do not count as loss.
+        """
+        reports = msg.get('reports', {})
+        interval = max(float(msg.get('interval', 1.0)), 0.1)
+        
+        with self.clients_lock:
+            info = self.clients.get(receiver)
+            if not info:
+                return
+            forwarded, info['forwarded'] = info['forwarded'], {}
+            
+            for sender, sent in forwarded.items():
+                sender_info = info['room'].members.get(sender)
+                if not sender_info or not sent:
+                    continue
+                report = reports.get(sender, {})
+                received = report.get('received', 0)
+                try:
+                    self.send_message(sender_info['tcp'], {
+                        'type': 'receiver_report',
+                        'receiver': receiver,
+                        'loss': round(max(0.0, 1.0 - received / sent), 3),
+                        'jitter': report.get('jitter', 0.0),
+                        'bitrate': report.get('bytes', 0) * 8 / interval
+                    })
+                except:
+                    pass
+    
+    def select_video_layer(self, room, info, sender, now):
+        """Layer of sender's video to forward to a receiver (see select_layer).
+
+        While anyone is speaking, everyone else is capped to the lowest layer.
+        Multicast receivers apply the same rule to the group's traffic.
+        """
+        requested = info['video_layers'].get(sender, DEFAULT_VIDEO_LAYER)
+        if room.active_speakers and sender not in room.active_speakers:
+            requested = 0  # High-quality layers are reserved for active speakers
+        published = [layer for layer, (received_at, _) in room.video_keyframes.get(sender, {}).items()
+                     if now - received_at < LAYER_TIMEOUT]
+        return select_layer(requested, published)
+    
+    def video_frame_due(self, info, sender, now, timestamp):
+        """Whether a receiver's fps cap allows sender's frame now.
+
+        Decided on the first fragment that arrives; the rest of the same
+        frame follows that decision.
+        """
+        max_fps = info['max_fps'].get(sender) or info['max_fps'].get(None)
+        if not max_fps:
+            return True
+        last, last_timestamp = info['last_video_sent'].get(sender, (0, None))
+        if timestamp == last_timestamp:
+            return True
+        if now - last < 1.0 / max_fps - FPS_SLACK:
+            return False
+        info['last_video_sent'][sender] = (now, timestamp)
+        return True
     
     def disconnect_client(self, username):
         """Handle client disconnection"""
         with self.clients_lock:
-            if username in self.clients:
+            info = self.clients.pop(username, None)
+            if info is None:
+                return
+            for sock in (info['tcp'], info['screen']):
+                if sock:
+                    # Shutdown wakes a screen thread still blocked on the socket
+                    self.drop_connection(sock)
+                    sock.close()
+            room = info['room']
+            room.members.pop(username, None)
+            self.forget_sender(room, username)
+            self.rate_buckets.pop(username, None)
+            self.rate_dropped.pop(username, None)
+            
+            # Clear presenter if disconnected
+            if room.presenter == username:
+                room.presenter = None
+                room.last_screen_frame = None
+        
+        print(f"[SERVER] {username} disconnected")
+        
+        # Notify others (outside the lock, which queue_presence takes itself)
+        self.queue_presence(room, username, joined=False)
+        self.send_to_peers({
+            'type': 'peer_leave',
+            'room': room.name,
+            'username': username
+        })
+    
+    def queue_presence(self, room, username, joined):
+        """Record a join or leave for the room's next presence delta"""
+        with self.clients_lock:
+            if joined:
+                if username not in room.presence_joined:
+                    room.presence_joined.append(username)
+            else:
+                # Still announced: snapshots sent meanwhile may list the user
+                if username in room.presence_joined:
+                    room.presence_joined.remove(username)
+                if username not in room.presence_left:
+                    room.presence_left.append(username)
+            if room.presence_flush_pending:
+                return
+            room.presence_flush_pending = True
+        # A join burst at the start of a meeting becomes one broadcast
+        threading.Timer(PRESENCE_COALESCE, self.flush_presence, args=(room,)).start()
+    
+    def flush_presence(self, room):
+        """Broadcast the room's pending joins and leaves as one numbered delta"""
+        with self.clients_lock:
+            room.presence_flush_pending = False
+            if not room.presence_joined and not room.presence_left:
+                return
+            room.presence_version += 1
+            message = {
+                'type': 'presence',
+                'version': room.presence_version,
+                'left': room.presence_left,  # Applied first, so leave + rejoin ends joined
+                'joined': room.presence_joined
+            }
+            room.presence_joined, room.presence_left = [], []
+        self.broadcast_tcp(room, message)
+    
+    def forget_sender(self, room, username):
+        """Drop a departed user's media state, and the room once it is empty"""
+        room.video_keyframes.pop(username, None)
+        room.audio_levels.pop(username, None)
+        for key in list(room.packet_cache):
+            if key[0] == username:
+                room.packet_cache.pop(key, None)
+                room.video_frame_parts.pop(key, None)
+        if not room.members and not room.remote_members:
+            self.rooms.pop(room.name, None)
+            room.multicast_group = None  # Free for the next new room
+            self.release_room(room.name)
+    
+    def settle_handoff(self, room_name):
+        """Worker mode: count a handed-off client as joined or turned away, and
+        report the room right away if it does not exist (under clients_lock)"""
+        if room_name is None:
+            return
+        self.room_handoffs[room_name] = self.room_handoffs.get(room_name, 0) + 1
+        if room_name not in self.rooms:
+            self.release_room(room_name)
+    
+    def release_room(self, name):
+        """Worker mode: report an empty room to the Supervisor (under clients_lock)"""
+        if self.handoff_conn is None:
+            return
+        try:
+            self.handoff_conn.send(('room_closed', name, self.room_handoffs.pop(name, 0)))
+        except (OSError, ValueError):
+            pass  # Supervisor gone; serve_handoffs shuts the worker down
+    
+    def get_room(self, name):
+        """Room by name, created (with its multicast group) on first use"""
+        room = self.rooms.get(name)
+        if room is None:
+            room = self.rooms[name] = Room(name)
+            if self.multicast_port:
+                room.multicast_group = self.allocate_multicast_group()
+                if room.multicast_group is None:
+                    print(f"[SERVER] No free multicast group; room '{name}' stays unicast")
+        return room
+    
+    def allocate_multicast_group(self):
+        """A (group, port) no live room uses, or None when all are taken.
+        Two rooms on one group would receive each other's media."""
+        used = {room.multicast_group[0] for room in self.rooms.values() if room.multicast_group}
+        for _ in range(254):
+            self.next_multicast_group = self.next_multicast_group % 254 + 1
+            group = MULTICAST_PREFIX + str(self.next_multicast_group)
+            if group not in used:
+                return (group, self.multicast_port)
+        return None
+    
+    def room_users(self, room):
+        """Everyone in a room, on this server and on peered servers"""
+        return list(room.members) + list(room.remote_members)
+    
+    def peer_hello(self):
+        """Handshake announcing this server, its media port and its local users"""
+        return {
+            'type': 'peer_hello',
+            'name': self.name,
+            'udp_port': self.udp_port,
+            'audio_udp_port': self.udp_audio_socket.getsockname()[1],
+            'users': {name: list(room.members) for name, room in self.rooms.items() if room.members}
+        }
+    
+    def connect_peer(self, host, port):
+        """Keep a link to another server open, reconnecting after failures"""
+        while self.running:
+            try:
+                sock = socket.create_connection((host, port), timeout=PEER_RETRY_INTERVAL)
+                sock.settimeout(SEND_TIMEOUT)
+                with self.clients_lock:
+                    hello = self.peer_hello()
+                self.send_message(sock, hello)
+                reader = FrameReader(sock)
+                reply = self.recv_message(reader)
+                if reply and reply.get('type') == 'peer_hello':
+                    self.handle_peer(reader, reply)
+                else:
+                    sock.close()
+            except OSError as e:
+                print(f"[SERVER] Peer {host}:{port} unreachable: {e}")
+            time.sleep(PEER_RETRY_INTERVAL)
+    
+    def handle_peer(self, reader, hello, reply=False):
+        """Serve a link to a peer server until it closes"""
+        sock = reader.sock
+        name = hello.get('name')
+        sock.settimeout(SEND_TIMEOUT)
+        peer_ip = sock.getpeername()[0]
+        peer = {'tcp': sock, 'udp_addr': (peer_ip, int(hello['udp_port']))}
+        # Media from the peer arrives from these; it relays audio out of a second socket
+        peer['media_addrs'] = {peer['udp_addr']}
+        if hello.get('audio_udp_port'):
+            peer['media_addrs'].add((peer_ip, int(hello['audio_udp_port'])))
+        with self.clients_lock:
+            if reply:
+                self.send_message(sock, self.peer_hello())
+            self.peers[name] = peer
+        print(f"[SERVER] Peered with {name}")
+        
+        try:
+            for room_name, usernames in hello.get('users', {}).items():
+                for username in usernames:
+                    self.add_remote_user(name, room_name, username)
+            
+            while self.running:
+                msg = self.recv_message(reader)
+                if not msg:
+                    break
+                self.process_peer_message(name, msg)
+        finally:
+            with self.clients_lock:
+                if self.peers.get(name) is peer:
+                    del self.peers[name]
+            for username, remote in list(self.remote_users.items()):
+                if remote['peer'] == name:
+                    self.remove_remote_user(username)
+            try:
+                sock.close()
+            except:
+                pass
+            print(f"[SERVER] Peer {name} disconnected")
+    
+    def process_peer_message(self, peer_name, msg):
+        """Apply chat and presence forwarded by a peer server"""
+        msg_type = msg.get('type')
+        
+        if msg_type == 'peer_join':
+            self.add_remote_user(peer_name, msg['room'], msg['username'])
+        
+        elif msg_type == 'peer_leave':
+            remote = self.remote_users.get(msg['username'])
+            if remote and remote['peer'] == peer_name:
+                self.remove_remote_user(msg['username'])
+        
+        elif msg_type == 'peer_chat':
+            room = self.rooms.get(msg['room'])
+            if room:
+                room.chat_history.append(msg['chat'])
+                self.broadcast_tcp(room, msg['chat'])
+    
+    def add_remote_user(self, peer_name, room_name, username):
+        """Record a user connected to a peer and announce them to the room"""
+        with self.clients_lock:
+            peer = self.peers.get(peer_name)
+            if not peer or username in self.clients:
+                return  # Local users win name clashes
+            room = self.get_room(room_name)
+            room.remote_members[username] = peer_name
+            self.remote_users[username] = {'peer': peer_name, 'room': room_name}
+        
+        print(f"[SERVER] {username} joined room '{room_name}' via {peer_name}")
+        self.queue_presence(room, username, joined=True)
+    
+    def remove_remote_user(self, username):
+        """Forget a user of a peer server and announce their departure"""
+        with self.clients_lock:
+            remote = self.remote_users.pop(username, None)
+            room = remote and self.rooms.get(remote['room'])
+            if not room:
+                return
+            room.remote_members.pop(username, None)
+            self.forget_sender(room, username)
+            self.rate_buckets.pop(username, None)
+            self.rate_dropped.pop(username, None)
+        
+        self.queue_presence(room, username, joined=False)
+    
+    def send_to_peers(self, message):
+        """Send a control message to every linked peer server"""
+        data = encode_message(message)
+        with self.clients_lock:
+            for peer in list(self.peers.values()):
                 try:
-                    self.clients[username]['tcp'].close()
-                except:
+                    send_all(peer['tcp'], data)
+                except OSError:
+                    self.drop_connection(peer['tcp'])
+    
+    def peer_for_addr(self, addr):
+        """Name of the peer server a datagram came from, or None for clients"""
+        for name, peer in list(self.peers.items()):
+            if addr in peer['media_addrs']:
+                return name
+        return None
+    
+    def forward_to_peers(self, room, data, send_socket):
+        """Send a local media packet once to each peer with members in the room"""
+        for peer_name in set(room.remote_members.values()):
+            peer = self.peers.get(peer_name)
+            if peer:
+                try:
+                    send_socket.sendto(data, peer['udp_addr'])
+                except Exception:
                     pass
-                del self.clients[username]
-                
-                # Clear presenter if disconnected
-                if self.presenter == username:
-                    self.presenter = None
-                
-                print(f"[SERVER] {username} disconnected")
-                
-                # Notify others
-                self.broadcast_tcp({
-                    'type': 'user_left',
-                    'username': username,
-                    'users': list(self.clients.keys()),
-                    'presenter': self.presenter
-                })
     
-    def send_message(self, sock, msg):
+    def send_heartbeats(self):
+        """Keep idle client and peer links busy so both ends can spot dead ones"""
+        data = encode_message({'type': 'heartbeat'})
+        while self.running:
+            time.sleep(HEARTBEAT_INTERVAL)
+            with self.clients_lock:
+                socks = [info['tcp'] for info in self.clients.values()]
+                socks += [peer['tcp'] for peer in self.peers.values()]
+                for sock in socks:
+                    try:
+                        send_all(sock, data)
+                    except OSError:
+                        self.drop_connection(sock)
+    
+    def drop_connection(self, sock):
+        """Shut a connection down so the thread reading it cleans up"""
+        try:
+            sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+    
+    def send_message(self, sock, msg, compress=False):
         """Send length-prefixed JSON message"""
-        data = json.dumps(msg).encode('utf-8')
-        sock.sendall(struct.pack('>I', len(data)) + data)
+        send_all(sock, encode_message(msg, compress, self.compression_stats))
     
-    def recv_message(self, sock):
-        """Receive length-prefixed JSON message"""
+    def recv_message(self, reader, idle_timeout=HEARTBEAT_TIMEOUT):
+        """Receive length-prefixed JSON message (None once the peer is gone or silent)"""
         try:
-            # Read message length
-            raw_msglen = self.recvall(sock, 4)
-            if not raw_msglen:
-                return None
-            msglen = struct.unpack('>I', raw_msglen)[0]
-            
-            # Read message data
-            data = self.recvall(sock, msglen)
-            if not data:
+            frame = reader.read_frame(idle_timeout)
+            if frame is None:
                 return None
-            
-            return json.loads(data.decode('utf-8'))
+            return decode_message(frame)
         except:
             return None
     
-    def recvall(self, sock, n):
-        """Helper to receive n bytes"""
-        data = bytearray()
-        while len(data) < n:
-            packet = sock.recv(n - len(data))
-            if not packet:
-                return None
-            data.extend(packet)
-        return bytes(data)
-    
     def shutdown(self):
         """Shutdown server"""
         self.running = False
@@ -305,17 +1345,199 @@ class LANServer:
             for username, info in self.clients.items():
                 try:
                     info['tcp'].close()
+                    if info['screen']:
+                        info['screen'].close()
                 except:
                     pass
         
         # Close server sockets
         if self.tcp_socket:
             self.tcp_socket.close()
+        self.relay_queue.close()
         if self.udp_socket:
             self.udp_socket.close()
+        if self.udp_audio_socket:
+            self.udp_audio_socket.close()
+        if self.screen_socket:
+            self.screen_socket.close()
         
         print("[SERVER] Server shutdown complete")
 
+
+def run_worker(conn, host, udp_port, screen_port, max_active_speakers, rate_limits=None):
+    """Entry point of a Supervisor worker process"""
+    server = LANServer(host=host, udp_port=udp_port, screen_port=screen_port,
+                       max_active_speakers=max_active_speakers, rate_limits=rate_limits)
+    server.serve_handoffs(conn)
+
+
+class Supervisor:
+    """Shards rooms across LANServer worker processes, one per core.
+
+    The supervisor only accepts TCP connections and reads the register
+    message. The socket is then passed to the worker that owns the room, and
+    that worker handles all further control traffic. Each worker has its own
+    UDP and screen ports, announced to the client in `registered`, so media
+    never passes through the supervisor. Worker i uses udp_port + 2*i and
+    screen_port + 2*i.
+    """
+    
+    def __init__(self, host='0.0.0.0', tcp_port=5555, udp_port=5556, screen_port=5557,
+                 workers=2, max_active_speakers=3, rate_limits=None):
+        self.host = host
+        self.tcp_port = tcp_port
+        self.udp_port = udp_port
+        self.screen_port = screen_port
+        self.max_active_speakers = max_active_speakers
+        self.rate_limits = rate_limits
+        self.worker_count = workers
+        
+        self.workers = []  # [{'process': Process, 'conn': Connection, 'lock': Lock, 'rooms': int}]
+        self.room_workers = {}  # {room name: worker index}
+        self.room_handoffs = {}  # {room name: clients handed to its worker and not yet reported back}
+        self.lock = threading.Lock()
+        self.tcp_socket = None
+        self.running = False
+    
+    # The supervisor reads exactly one framed message per connection
+    recv_message = LANServer.recv_message
+    
+    def start(self):
+        """Start the workers and route incoming connections to them"""
+        self.running = True
+        # Spawned workers inherit no pipes of their siblings, so each one sees
+        # EOF and shuts down as soon as the supervisor goes away
+        context = multiprocessing.get_context('spawn')
+        for i in range(self.worker_count):
+            parent_conn, child_conn = context.Pipe()
+            process = context.Process(
+                target=run_worker,
+                args=(child_conn, self.host, self.udp_port + 2 * i, self.screen_port + 2 * i,
+                      self.max_active_speakers, self.rate_limits),
+                daemon=True)
+            process.start()
+            child_conn.close()
+            self.workers.append({'process': process, 'conn': parent_conn,
+                                 'lock': threading.Lock(), 'rooms': 0})
+            threading.Thread(target=self.watch_worker, args=(i,), daemon=True).start()
+        
+        self.tcp_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.tcp_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.tcp_socket.bind((self.host, self.tcp_port))
+        self.tcp_socket.listen(10)
+        print(f"[SUPERVISOR] TCP listening on {self.host}:{self.tcp_port} with {self.worker_count} workers")
+        
+        try:
+            while self.running:
+                try:
+                    self.tcp_socket.settimeout(1.0)
+                    client_sock, addr = self.tcp_socket.accept()
+                    threading.Thread(target=self.route_client, args=(client_sock, addr), daemon=True).start()
+                except socket.timeout:
+                    continue
+        except KeyboardInterrupt:
+            print("\n[SUPERVISOR] Shutting down...")
+        finally:
+            self.shutdown()
+    
+    def route_client(self, client_sock, addr):
+        """Read a client's register message and pass the connection to its room's worker"""
+        room_name = worker = None
+        try:
+            client_sock.settimeout(SEND_TIMEOUT)
+            register = self.recv_message(FrameReader(client_sock))
+            if not isinstance(register, dict) or register.get('type') != 'register':
+                return
+            if not valid_register(register):
+                print(f"[SUPERVISOR] Malformed register from {addr}")
+                return
+            room_name = str(register.get('room') or DEFAULT_ROOM)
+            worker = self.worker_for_room(room_name)
+            with worker['lock']:
+                worker['conn'].send((register, addr))
+                send_handle(worker['conn'], client_sock.fileno(), worker['process'].pid)
+        except Exception as e:
+            print(f"[SUPERVISOR] Could not route {addr}: {e}")
+            if worker is not None:
+                self.cancel_handoff(room_name, self.workers.index(worker))
+        finally:
+            # The worker holds its own duplicate of the connection now
+            client_sock.close()
+    
+    def worker_for_room(self, room_name):
+        """Worker owning a room; new rooms go to the live worker with the fewest"""
+        with self.lock:
+            index = self.room_workers.get(room_name)
+            if index is not None and not self.workers[index]['process'].is_alive():
+                self.drop_worker(index)
+                index = None
+            if index is None:
+                alive = [i for i, worker in enumerate(self.workers) if worker['process'].is_alive()]
+                if not alive:
+                    raise RuntimeError("no worker process is running")
+                index = min(alive, key=lambda i: self.workers[i]['rooms'])
+                self.room_workers[room_name] = index
+                self.workers[index]['rooms'] += 1
+                print(f"[SUPERVISOR] Room '{room_name}' assigned to worker {index}")
+            self.room_handoffs[room_name] = self.room_handoffs.get(room_name, 0) + 1
+            return self.workers[index]
+    
+    def cancel_handoff(self, room_name, index):
+        """Undo worker_for_room's count for a client that never reached the worker"""
+        with self.lock:
+            if self.room_workers.get(room_name) != index:
+                return
+            self.room_handoffs[room_name] -= 1
+            if self.room_handoffs[room_name] > 0:
+                return
+            # Every earlier handoff was reported closed, so the worker has no such room
+            del self.room_handoffs[room_name], self.room_workers[room_name]
+            self.workers[index]['rooms'] -= 1
+    
+    def watch_worker(self, index):
+        """Release the rooms a worker reports empty; reassign them all if it dies"""
+        conn = self.workers[index]['conn']
+        while self.running:
+            try:
+                _, room_name, settled = conn.recv()
+            except (EOFError, OSError):
+                break
+            with self.lock:
+                if self.room_workers.get(room_name) != index:
+                    continue
+                # Clients still on their way to the worker will re-create the room there
+                self.room_handoffs[room_name] -= settled
+                if self.room_handoffs[room_name] > 0:
+                    continue
+                del self.room_handoffs[room_name], self.room_workers[room_name]
+                self.workers[index]['rooms'] -= 1
+                print(f"[SUPERVISOR] Room '{room_name}' closed on worker {index}")
+        if self.running:
+            with self.lock:
+                self.drop_worker(index)
+    
+    def drop_worker(self, index):
+        """Forget the rooms of a worker that exited (under self.lock)"""
+        rooms = [name for name, i in self.room_workers.items() if i == index]
+        if not rooms and not self.workers[index]['rooms']:
+            return
+        for name in rooms:
+            del self.room_workers[name]
+            self.room_handoffs.pop(name, None)
+        self.workers[index]['rooms'] = 0
+        print(f"[SUPERVISOR] Worker {index} exited; its rooms go to the remaining workers")
+    
+    def shutdown(self):
+        """Stop accepting clients and terminate the workers"""
+        self.running = False
+        if self.tcp_socket:
+            self.tcp_socket.close()
+        for worker in self.workers:
+            worker['conn'].close()
+            worker['process'].terminate()
+        print("[SUPERVISOR] Shutdown complete")
+
+
 if __name__ == "__main__":
     import sys
     
@@ -323,11 +1545,48 @@ if __name__ == "__main__":
     host = '0.0.0.0'  # Listen on all interfaces
     tcp_port = 5555
     udp_port = 5556
+    screen_port = 5557
+    
+    # Optional: python server.py [tcp] [udp] [screen] --speakers 3 (0 = relay everyone)
+    #           --workers N shards rooms across N processes
+    #           --peer host:tcp_port links to another server (repeatable)
+    #           --multicast 5600 sends room media to multicast groups on that port
+    #           --rate-limit video=6000 caps each sender's stream in KB/s (repeatable, 0 = off)
+    max_active_speakers = 3
+    if '--speakers' in sys.argv:
+        index = sys.argv.index('--speakers')
+        max_active_speakers = int(sys.argv[index + 1])
+        del sys.argv[index:index + 2]
+    peers = []
+    while '--peer' in sys.argv:
+        index = sys.argv.index('--peer')
+        peer_host, peer_port = sys.argv[index + 1].rsplit(':', 1)
+        peers.append((peer_host, int(peer_port)))
+        del sys.argv[index:index + 2]
+    multicast_port = None
+    if '--multicast' in sys.argv:
+        index = sys.argv.index('--multicast')
+        multicast_port = int(sys.argv[index + 1])
+        del sys.argv[index:index + 2]
+    rate_limits = dict(RATE_LIMITS)
+    stream_types = {name: stream_type for stream_type, name in STREAM_NAMES.items()}
+    while '--rate-limit' in sys.argv:
+        index = sys.argv.index('--rate-limit')
+        name, rate = sys.argv[index + 1].split('=')
+        rate_limits[stream_types[name]] = int(rate)
+        del sys.argv[index:index + 2]
+    workers = 0
+    if '--workers' in sys.argv:
+        index = sys.argv.index('--workers')
+        workers = int(sys.argv[index + 1])
+        del sys.argv[index:index + 2]
     
     if len(sys.argv) > 1:
         tcp_port = int(sys.argv[1])
     if len(sys.argv) > 2:
         udp_port = int(sys.argv[2])
+    if len(sys.argv) > 3:
+        screen_port = int(sys.argv[3])
     
     # Display server IP
     hostname = socket.gethostname()
@@ -338,9 +1597,32 @@ if __name__ == "__main__":
     print(f"Server IP: {local_ip}")
     print(f"TCP Port: {tcp_port}")
     print(f"UDP Port: {udp_port}")
+    print(f"Screen Port: {screen_port}")
+    print(f"Active Speakers: {max_active_speakers or 'all'}")
+    print("Rate Limits (KB/s): " + ", ".join(f"{STREAM_NAMES[t]} {rate or 'off'}"
+                                             for t, rate in rate_limits.items()))
+    if workers:
+        print(f"Workers: {workers} (UDP/screen ports step by 2 per worker)")
+    if peers and workers:
+        print("Peers: ignored with --workers (single-process mode only)")
+    else:
+        for peer_host, peer_port in peers:
+            print(f"Peer: {peer_host}:{peer_port}")
+    if multicast_port:
+        if workers:
+            print("Multicast: ignored with --workers (single-process mode only)")
+        else:
+            print(f"Multicast: {MULTICAST_PREFIX}x port {multicast_port}")
     print(f"{'='*50}\n")
     print("Clients should connect to this IP address")
     print("Press Ctrl+C to stop the server\n")
     
-    server = LANServer(host=host, tcp_port=tcp_port, udp_port=udp_port)
+    if workers:
+        server = Supervisor(host=host, tcp_port=tcp_port, udp_port=udp_port, screen_port=screen_port,
+                            workers=workers, max_active_speakers=max_active_speakers,
+                            rate_limits=rate_limits)
+    else:
+        server = LANServer(host=host, tcp_port=tcp_port, udp_port=udp_port, screen_port=screen_port,
+                           max_active_speakers=max_active_speakers, peers=peers,
+                           multicast_port=multicast_port, rate_limits=rate_limits)
     server.start()
\ No newline at end of file
@@ -0,0 +1,139 @@
+#!/usr/bin/env python3
+"""
+FEC Test - Verifies parity recovery and in-order audio playout
+"""
+
+import sys
+
+from common import (FecEncoder, FecDecoder, PlayoutBuffer, pack_media_packet, parse_media_packet,
+                    STREAM_VIDEO, STREAM_AUDIO, FEC_FLAG, FEC_MIN_GROUP, FEC_MAX_GROUP)
+
+GROUP_SIZE = 5
+
+
+def make_group(stream_type, first_seq=0):
+    """Encode one FEC group; returns (data packets, parity packet)"""
+    encoder = FecEncoder(GROUP_SIZE)
+    packets = []
+    parity = None
+    for i in range(GROUP_SIZE):
+        seq = (first_seq + i) & 0xFFFF
+        payload = bytes([i + 1]) * (100 + 37 * i)  # Unequal lengths exercise the padding
+        frag_index, frag_count = (i, GROUP_SIZE) if stream_type == STREAM_VIDEO else (0, 1)
+        packets.append(parse_media_packet(pack_media_packet(
+            stream_type, 'Alice', payload, seq=seq, timestamp=1000 + i,
+            frag_index=frag_index, frag_count=frag_count)))
+        result = encoder.add(seq, 1000 + i, payload, frag_index, frag_count)
+        if result is not None:
+            base_seq, parity_payload = result
+            parity = parse_media_packet(pack_media_packet(
+                stream_type | FEC_FLAG, 'Alice', parity_payload, seq=base_seq))
+    return packets, parity
+
+
+def test_recover_each_position():
+    """Drop every position of a group in turn and rebuild it from parity"""
+    print("🔍 Testing FEC recovery of each lost position...")
+    for stream_type, name in ((STREAM_AUDIO, 'audio'), (STREAM_VIDEO, 'video')):
+        for first_seq in (0, 0xFFFE):  # Also across the 16-bit wrap
+            for lost in range(GROUP_SIZE):
+                packets, parity = make_group(stream_type, first_seq)
+                decoder = FecDecoder()
+                for i, packet in enumerate(packets):
+                    if i != lost:
+                        decoder.add(packet)
+                recovered = decoder.recover(parity)
+                expected = packets[lost]
+                assert recovered is not None, f"{name}: position {lost} not recovered"
+                assert recovered.seq == expected.seq
+                assert recovered.payload == expected.payload
+                assert recovered.timestamp == expected.timestamp
+                assert (recovered.frag_index, recovered.frag_count) == \
+                    (expected.frag_index, expected.frag_count)
+        print(f"   ✅ {name}: every position of a {GROUP_SIZE}-packet group recovered")
+
+
+def test_two_losses_not_recovered():
+    """A group with two losses cannot be rebuilt"""
+    print("\n🔍 Testing FEC with two losses in a group...")
+    packets, parity = make_group(STREAM_AUDIO)
+    decoder = FecDecoder()
+    for packet in packets[2:]:
+        decoder.add(packet)
+    assert decoder.recover(parity) is None
+    print("   ✅ Two losses are left to the receiver")
+
+
+def test_group_size_limits():
+    """Group sizes that cannot be sent in the one-byte header are refused"""
+    print("\n🔍 Testing FEC group size limits...")
+    for bad in (-1, 0, 1, FEC_MAX_GROUP + 1, 1000):
+        try:
+            FecEncoder(bad)
+        except ValueError:
+            continue
+        assert False, f"group size {bad} accepted"
+    encoder = FecEncoder(FEC_MAX_GROUP)
+    results = [encoder.add(seq, 0, b'x') for seq in range(FEC_MAX_GROUP)]
+    assert results[-1] is not None and results[-1][1][0] == FEC_MAX_GROUP
+    assert FecEncoder(FEC_MIN_GROUP).add(0, 0, b'x') is None
+    print(f"   ✅ Sizes outside {FEC_MIN_GROUP}..{FEC_MAX_GROUP} rejected, the limits work")
+
+
+def test_audio_playout_order():
+    """Rebuilt audio plays in seq order whichever position was lost"""
+    print("\n🔍 Testing audio playout order with FEC...")
+    for lost in range(GROUP_SIZE):
+        decoder = FecDecoder()
+        playout = PlayoutBuffer(depth=GROUP_SIZE + 1)
+        played = []
+        for packet in make_group(STREAM_AUDIO)[0]:  # A clean group starts the stream
+            played += playout.add(packet, now=0)
+        packets, parity = make_group(STREAM_AUDIO, GROUP_SIZE)
+        for i, packet in enumerate(packets):
+            if i != lost:
+                decoder.add(packet)
+                played += playout.add(packet, now=0)
+        played += playout.add(decoder.recover(parity), now=0)
+        assert [p.seq for p in played] == list(range(2 * GROUP_SIZE)), \
+            f"position {lost} played as {[p.seq for p in played]}"
+    print("   ✅ Every lost position played back in order")
+
+
+def test_audio_playout_gives_up():
+    """An unrecoverable gap is skipped once parity can no longer fill it"""
+    print("\n🔍 Testing audio playout past an unrecoverable gap...")
+    packets, _ = make_group(STREAM_AUDIO)
+    playout = PlayoutBuffer(depth=GROUP_SIZE + 1, max_wait=0.2)
+    assert [p.seq for p in playout.add(packets[0], now=0)] == [0]
+    assert playout.add(packets[2], now=0) == []  # Seq 1 is missing: hold back
+    assert playout.expire(now=0.1) == []
+    assert [p.seq for p in playout.expire(now=0.3)] == [2]
+    assert playout.add(packets[1], now=0.3) == []  # Too late to play
+    print("   ✅ Held back for max_wait, then skipped the gap")
+
+
+def main():
+    print("=" * 60)
+    print("  LAN COLLABORATION SUITE - FEC TEST")
+    print("=" * 60)
+
+    tests = [test_recover_each_position, test_two_losses_not_recovered, test_group_size_limits,
+             test_audio_playout_order, test_audio_playout_gives_up]
+    failed = 0
+    for test in tests:
+        try:
+            test()
+        except AssertionError as e:
+            print(f"   ❌ {test.__name__} failed: {e}")
+            failed += 1
+
+    print("\n" + "=" * 60)
+    if failed:
+        print(f"❌ {failed} of {len(tests)} FEC tests failed")
+        return 1
+    print("🎉 ALL FEC TESTS PASSED!")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
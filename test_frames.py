@@ -0,0 +1,140 @@
+#!/usr/bin/env python3
+"""
+Framing Test - Verifies FrameReader on split, batched, compressed and hostile TCP input
+"""
+
+import socket
+import struct
+import sys
+import threading
+import time
+import zlib
+
+from common import FrameReader, encode_message, decode_message, MAX_FRAME, COMPRESSED_FLAG
+
+
+def reader_pair():
+    """A connected socket pair with a FrameReader on the receiving end"""
+    sender, receiver = socket.socketpair()
+    receiver.settimeout(1.0)
+    return sender, FrameReader(receiver, size=64)
+
+
+def test_split_reads():
+    """Frames arriving one byte at a time are reassembled intact"""
+    print("🔍 Testing frames split into single-byte reads...")
+    sender, reader = reader_pair()
+    messages = [{'type': 'chat', 'message': 'x' * size} for size in (0, 10, 300, 5000)]
+    data = b''.join(encode_message(msg) for msg in messages)
+
+    def trickle():
+        for i in range(len(data)):
+            sender.send(data[i:i + 1])
+            if i % 512 == 0:
+                time.sleep(0.001)  # Let the reader see partial prefixes and payloads
+        sender.close()
+    threading.Thread(target=trickle, daemon=True).start()
+
+    for msg in messages:
+        frame = reader.read_frame(idle_timeout=5)
+        assert frame is not None, "frame lost"
+        assert decode_message(frame) == msg
+    assert reader.read_frame(idle_timeout=5) is None, "EOF not reported"
+    print("   ✅ Byte-by-byte frames reassembled, buffer grew to fit")
+
+
+def test_batched_reads():
+    """Several frames delivered by one recv are handed out one at a time"""
+    print("\n🔍 Testing several frames in one read...")
+    sender, reader = reader_pair()
+    messages = [{'type': 'heartbeat'}, {'type': 'chat', 'message': 'hi'}, {'type': 'heartbeat'}]
+    sender.sendall(b''.join(encode_message(msg) for msg in messages))
+    for msg in messages:
+        assert decode_message(reader.read_frame(idle_timeout=5)) == msg
+    sender.close()
+    print("   ✅ Batched frames split correctly")
+
+
+def test_eof_mid_frame():
+    """A connection closed halfway through a frame reads as end of stream"""
+    print("\n🔍 Testing EOF inside a frame...")
+    sender, reader = reader_pair()
+    sender.sendall(encode_message({'type': 'chat', 'message': 'y' * 100})[:50])
+    sender.close()
+    assert reader.read_frame(idle_timeout=5) is None
+    print("   ✅ Truncated frame reported as EOF")
+
+
+def test_oversized_prefix():
+    """A huge length prefix neither allocates memory nor waits for the data"""
+    print("\n🔍 Testing an oversized length prefix...")
+    sender, reader = reader_pair()
+    sender.sendall(struct.pack('>I', MAX_FRAME + 1) + b'hello')
+    assert reader.read_frame(idle_timeout=5) is None
+    assert len(reader.buffer) < 1 << 16, f"buffer grew to {len(reader.buffer)} bytes"
+
+    # Below the limit, memory only follows the bytes that actually arrive
+    sender, reader = reader_pair()
+    sender.sendall(struct.pack('>I', 0x7000000) + b'hello')
+    sender.close()
+    assert reader.read_frame(idle_timeout=5) is None
+    assert len(reader.buffer) < 1 << 16, f"buffer grew to {len(reader.buffer)} bytes"
+    print("   ✅ Oversized prefix dropped without allocating it")
+
+
+def compressed_frame(payload):
+    """A frame with bit 31 set, as encode_message sends compressed ones"""
+    packed = zlib.compress(payload)
+    return struct.pack('>I', len(packed) | COMPRESSED_FLAG) + packed
+
+
+def test_compressed_frames():
+    """Compressed frames only decode on connections that agreed to zlib"""
+    print("\n🔍 Testing compressed frames...")
+    msg = {'type': 'chat', 'message': 'z' * 5000}
+    sender, reader = reader_pair()
+    reader.compressed = True
+    sender.sendall(encode_message(msg, compress=True))
+    assert decode_message(reader.read_frame(idle_timeout=5)) == msg
+
+    sender, reader = reader_pair()
+    sender.sendall(encode_message(msg, compress=True))
+    assert reader.read_frame(idle_timeout=5) is None, "accepted without negotiation"
+    print("   ✅ Decoded when negotiated, dropped otherwise")
+
+
+def test_decompression_bomb():
+    """A frame inflating past MAX_FRAME is dropped"""
+    print("\n🔍 Testing a frame that inflates past MAX_FRAME...")
+    sender, reader = reader_pair()
+    reader.compressed = True
+    data = compressed_frame(bytes(MAX_FRAME + 1))
+    threading.Thread(target=sender.sendall, args=(data,), daemon=True).start()
+    assert reader.read_frame(idle_timeout=5) is None
+    print("   ✅ Oversized output dropped")
+
+
+def main():
+    print("=" * 60)
+    print("  LAN COLLABORATION SUITE - FRAMING TEST")
+    print("=" * 60)
+
+    tests = [test_split_reads, test_batched_reads, test_eof_mid_frame, test_oversized_prefix,
+             test_compressed_frames, test_decompression_bomb]
+    failed = 0
+    for test in tests:
+        try:
+            test()
+        except AssertionError as e:
+            print(f"   ❌ {test.__name__} failed: {e}")
+            failed += 1
+
+    print("\n" + "=" * 60)
+    if failed:
+        print(f"❌ {failed} of {len(tests)} framing tests failed")
+        return 1
+    print("🎉 ALL FRAMING TESTS PASSED!")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
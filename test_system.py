@@ -8,6 +8,8 @@ import json
 import struct
 import sys
 
+from common import pack_media_packet, STREAM_VIDEO
+
 def test_server_connection():
     """Test if server is reachable"""
     print("🔍 Testing Server Connection...")
@@ -67,7 +69,7 @@ def test_udp_port():
         udp_sock.settimeout(2)
         
         # Send a test packet
-        test_packet = b'\x01\x08TestUser' + b'Test data'
+        test_packet = pack_media_packet(STREAM_VIDEO, 'TestUser', b'Test data')
         udp_sock.sendto(test_packet, ('127.0.0.1', 5556))
         print("   ✅ UDP packet sent to port 5556")
         
@@ -114,6 +116,7 @@ def check_files():
     required_files = [
         'server.py',
         'client.py',
+        'common.py',
         'requirements.txt',
         'README.md',
         'TESTING_GUIDE.md',